@@ -0,0 +1,109 @@
+import time
+from dataclasses import dataclass, field
+
+INITIAL_LATENCY = 1.0
+LATENCY_SMOOTHING = 0.3
+FAILURE_THRESHOLD = 3
+MIN_OPEN_DURATION = 10.0
+MAX_OPEN_DURATION = 300.0
+
+@dataclass
+class BackendOptions:
+  api_key: str = field(repr=False)
+  model_name: str = 'gpt-3.5-turbo'
+  azure_endpoint: str|None = None
+  weight: float = 1
+
+  @staticmethod
+  def parse(text: str) -> 'BackendOptions':
+    values = dict(item.split('=', 1) for item in text.split(',') if item)
+    if 'api_key' not in values:
+      raise ValueError(f"Backend must specify api_key")
+
+    return BackendOptions(
+      values['api_key'],
+      values.get('model_name') or 'gpt-3.5-turbo',
+      values.get('azure_endpoint'),
+      float(values.get('weight') or 1),
+    )
+
+class Backend:
+  def __init__(self, options: BackendOptions):
+    self.options = options
+    self.outstanding_count = 0
+    self.latency = INITIAL_LATENCY
+    self.__failure_count = 0
+    self.__open_duration = MIN_OPEN_DURATION
+    self.__open_until = 0.0
+    self.__is_probing = False
+
+  def __repr__(self) -> str:
+    return f"{self.options.azure_endpoint or 'openai'}/{self.options.model_name}"
+
+  @property
+  def score(self) -> float:
+    return (self.outstanding_count + 1) * self.latency / self.options.weight
+
+  @property
+  def is_available(self) -> bool:
+    if self.__failure_count < FAILURE_THRESHOLD:
+      return True
+    # After the breaker has been open for a while, let a single request through to probe the backend
+    return time.monotonic() >= self.__open_until and not self.__is_probing
+
+  @property
+  def open_until(self) -> float:
+    return self.__open_until
+
+  def acquire(self) -> bool:
+    self.outstanding_count += 1
+    # Only a request let through by the half-open breaker is the probe, not one sent while all backends are open
+    if self.__failure_count >= FAILURE_THRESHOLD and self.is_available:
+      self.__is_probing = True
+      return True
+    return False
+
+  def release(self, is_probe: bool):
+    self.outstanding_count -= 1
+    # Requests sent before the breaker opened can finish while the probe is still in flight
+    if is_probe:
+      self.__is_probing = False
+
+  def record_success(self, latency: float):
+    self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+    self.__failure_count = 0
+    self.__open_duration = MIN_OPEN_DURATION
+
+  def record_failure(self, retry_after: float|None = None):
+    self.__failure_count += 1
+    if retry_after:
+      self.__failure_count = max(self.__failure_count, FAILURE_THRESHOLD)
+      self.__open_until = time.monotonic() + retry_after
+    elif self.__failure_count >= FAILURE_THRESHOLD:
+      self.__open_until = time.monotonic() + self.__open_duration
+      self.__open_duration = min(self.__open_duration * 2, MAX_OPEN_DURATION)
+
+@dataclass
+class BackendLease:
+  backend: Backend
+  is_probe: bool
+
+  def release(self):
+    self.backend.release(self.is_probe)
+
+class BackendPool:
+  def __init__(self, options: list[BackendOptions]):
+    self.backends = [Backend(backend_options) for backend_options in options]
+
+  def acquire(self, excluded_backends: list[Backend]) -> BackendLease|None:
+    candidates = [backend for backend in self.backends if backend not in excluded_backends]
+    if not candidates:
+      return None
+
+    available_backends = [backend for backend in candidates if backend.is_available]
+    if available_backends:
+      backend = min(available_backends, key=lambda backend: backend.score)
+    else:
+      backend = min(candidates, key=lambda backend: backend.open_until)
+
+    return BackendLease(backend, backend.acquire())
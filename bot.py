@@ -2,16 +2,22 @@ import asyncio
 import logging
 import os
 from chat import ChatData, ChatManager, ChatState, ChatContext
+from chat_queue import ChatQueue
 from dataclasses import dataclass, field
+from edits import EditScheduler
+from expiry import ExpiryScheduler
 from enum import Enum
 from gpt import GPTClient
+from persistence import ChatLogPersistence, SQLitePersistence
 from speech import SpeechClient
+from speech_cache import SpeechCache
 from telegram import Update
-from telegram.ext import Application, CallbackQueryHandler, ConversationHandler, PicklePersistence, filters, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler
+from telegram.ext import Application, ExtBot, CallbackQueryHandler, ConversationHandler, filters, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler
 from telegram.warnings import PTBUserWarning
-from typing import cast
+from typing import Callable, cast
 from uuid import uuid4
 from warnings import filterwarnings
+from workers import run_workers
 
 async def __start(_: Update, chat_manager: ChatManager):
   chat_id = chat_manager.context.chat_id
@@ -20,12 +26,18 @@ async def __start(_: Update, chat_manager: ChatManager):
 
   logging.info(f"Start command executed for chat {chat_id}")
 
-async def __handle_message(update: Update, chat_manager: ChatManager):
+async def __handle_message(update: Update, chat_manager: ChatManager, chat_queue: ChatQueue, interrupt_generation: bool):
   if not update.message or not update.message.text:
     logging.warning(f"Update received but ignored because it doesn't have a message")
     return
 
-  await chat_manager.handle_message(text=update.message.text, user_message_id=update.message.id)
+  if interrupt_generation:
+    chat_manager.stop_generation()
+
+  async def handle(text: str, user_message_id: int):
+    await chat_manager.handle_message(text=text, user_message_id=user_message_id)
+
+  await chat_queue.run_message(chat_manager.context.chat_id, update.message.text, update.message.id, handle)
 
 async def __handle_audio(update: Update, chat_manager: ChatManager):
   if not update.message or not update.message.voice:
@@ -33,11 +45,13 @@ async def __handle_audio(update: Update, chat_manager: ChatManager):
     return
 
   file = await update.message.voice.get_file()
-  audio = await file.download_as_bytearray()
+  if not file.file_path:
+    logging.warning(f"Audio received from chat {chat_manager.context.chat_id} but ignored because it can't be downloaded")
+    return
 
   logging.info(f"Received audio from chat {chat_manager.context.chat_id}")
 
-  await chat_manager.handle_audio(audio=audio, user_message_id=update.message.id)
+  await chat_manager.handle_audio(audio_url=file.file_path, user_message_id=update.message.id)
 
 async def __retry_last_message(update: Update, chat_manager: ChatManager):
   query = update.callback_query
@@ -60,11 +74,32 @@ async def __resume(update: Update, chat_manager: ChatManager):
 
   await chat_manager.resume(conversation_id=conversation_id)
 
+async def __stop_generation(update: Update, chat_manager: ChatManager):
+  is_stopped = chat_manager.stop_generation()
+
+  if update.callback_query:
+    await update.callback_query.answer(text=None if is_stopped else "No response is being generated")
+  elif not is_stopped:
+    await chat_manager.bot.send_message(chat_id=chat_manager.context.chat_id, text="No response is being generated")
+
 async def __new_conversation(_: Update, chat_manager: ChatManager):
   await chat_manager.new_conversation()
 
-async def __show_conversation_history(_: Update, chat_manager: ChatManager):
-  await chat_manager.show_conversation_history()
+async def __show_conversation_history(update: Update, chat_manager: ChatManager):
+  query = update.callback_query
+  if query and query.data and query.data.startswith('/history_'):
+    await query.answer()
+    await chat_manager.show_conversation_history(page=int(query.data[len('/history_'):]), sent_message_id=query.message.message_id if query.message else None)
+  else:
+    await chat_manager.show_conversation_history()
+
+async def __search_conversations(update: Update, chat_manager: ChatManager):
+  query = ' '.join(update.message.text.split()[1:]) if update.message and update.message.text else ''
+  if not query:
+    await chat_manager.bot.send_message(chat_id=chat_manager.context.chat_id, text="Send /search followed by words to search for")
+    return
+
+  await chat_manager.search_conversations(query)
 
 async def __read_out_message(update: Update, chat_manager: ChatManager):
   if not update.message or not update.message.reply_to_message:
@@ -196,18 +231,17 @@ class BotOptions:
   allowed_chat_ids: set[int]
   conversation_timeout: int|None = None
   data_dir: str|None = None
+  storage: str = 'log'
+  stream_by_sentence: bool = False
+  merge_messages: bool = False
+  interrupt_generation: bool = False
+  speech_cache_size: int = 0
+  workers: int = 1
   webhook: WebhookOptions|None = None
 
-def __create_callback(gpt: GPTClient, speech: SpeechClient|None, chat_tasks: dict[int, asyncio.Task], allowed_chat_ids: set[int], conversation_timeout: int|None, chat_states: dict[int, ChatState], callback):
+def __create_callback(create_chat_manager: Callable[[Application, ExtBot, int], ChatManager], chat_queue: ChatQueue, allowed_chat_ids: set[int], callback, serialized: bool):
   async def invoke(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    if chat_id not in chat_states:
-      chat_states[chat_id] = ChatState()
-    chat_state = chat_states[chat_id]
-
-    chat_data = cast(ChatData, context.chat_data)
-    chat_context = ChatContext(chat_id, chat_state, chat_data)
-
-    chat_manager = ChatManager(gpt=gpt, speech=speech, bot=context.bot, context=chat_context, conversation_timeout=conversation_timeout)
+    chat_manager = create_chat_manager(context.application, context.bot, chat_id)
 
     return await callback(update, chat_manager)
 
@@ -222,49 +256,98 @@ def __create_callback(gpt: GPTClient, speech: SpeechClient|None, chat_tasks: dic
       logging.info(f"Message received for chat {chat_id} but ignored because it's not the configured chat")
       return
 
-    current_task = chat_tasks.get(chat_id)
-    async def task():
-      if current_task:
-        try:
-          await current_task
-        except Exception as e:
-          logging.warn(f"Error {e} in previous task for chat {chat_id}")
+    if not serialized:
       return await invoke(update, context, chat_id)
 
-    chat_tasks[chat_id] = asyncio.create_task(task())
-    result = await chat_tasks[chat_id]
-    if chat_id in chat_tasks:
-      del chat_tasks[chat_id]
-
-    return result
+    return await chat_queue.run(chat_id, lambda: invoke(update, context, chat_id))
 
   return handler
 
-def run(token: str, gpt: GPTClient, speech: SpeechClient|None, options: BotOptions):
-  chat_tasks = {}
+def __build_application(token: str, gpt: GPTClient, speech: SpeechClient|None, options: BotOptions, owns_chat: Callable[[int], bool]|None = None) -> Application:
   chat_states = {}
+  edits = EditScheduler()
+  chat_queue = ChatQueue(merge_messages=options.merge_messages)
+  speech_cache = None
+  if speech and options.speech_cache_size:
+    speech_cache = SpeechCache(max_size=options.speech_cache_size, directory=os.path.join(options.data_dir, 'speech') if options.data_dir else None)
+
+  def create_chat_manager(app: Application, bot: ExtBot, chat_id: int) -> ChatManager:
+    is_new_chat_state = chat_id not in chat_states
+    if is_new_chat_state:
+      chat_states[chat_id] = ChatState()
+    chat_state = chat_states[chat_id]
+
+    chat_data = cast(ChatData, app.chat_data[chat_id])
+    persistence = app.persistence
+    load_messages = persistence.load_messages if isinstance(persistence, SQLitePersistence) else None
+    read_messages = persistence.read_messages if isinstance(persistence, SQLitePersistence) else None
+    read_message_ids = persistence.read_message_ids if isinstance(persistence, SQLitePersistence) else None
+    chat_context = ChatContext(chat_id, chat_state, chat_data, load_messages, read_messages, read_message_ids)
+    if is_new_chat_state and expiry:
+      chat_context.restore_current_conversation()
+
+    return ChatManager(gpt=gpt, speech=speech, speech_cache=speech_cache, edits=edits, expiry=expiry, bot=bot, context=chat_context, conversation_timeout=options.conversation_timeout, stream_by_sentence=options.stream_by_sentence)
+
+  # Only operations on the conversation are run one after another, while other operations of the chat run right away
+  def create_callback(callback, serialized: bool = False):
+    return __create_callback(create_chat_manager, chat_queue, options.allowed_chat_ids, callback, serialized)
+
+  async def expire_conversations(chat_ids: list[int]):
+    async def expire(chat_id: int):
+      chat_manager = create_chat_manager(app, app.bot, chat_id)
+      expires_at = await chat_queue.run(chat_id, chat_manager.expire_conversation)
+      if expires_at is not None and expiry:
+        expiry.schedule(chat_id, expires_at)
+
+    results = await asyncio.gather(*(expire(chat_id) for chat_id in chat_ids), return_exceptions=True)
+    for chat_id, result in zip(chat_ids, results):
+      if isinstance(result, Exception):
+        logging.warning(f"Could not expire conversation of chat {chat_id}: {result}")
+
+    # Changes made outside of handlers are only persisted when marked
+    app.mark_data_for_update_persistence(chat_ids=chat_ids)
+    logging.info(f"Expired conversations of {len(chat_ids)} chats")
 
-  def create_callback(callback):
-    return __create_callback(gpt, speech, chat_tasks, options.allowed_chat_ids, options.conversation_timeout, chat_states, callback)
+  # A single scheduler expires the conversations of all chats
+  expiry = ExpiryScheduler(expire_conversations) if options.conversation_timeout else None
+
+  async def handle_message(update: Update, chat_manager: ChatManager):
+    await __handle_message(update, chat_manager, chat_queue, options.interrupt_generation)
 
   async def post_init(app: Application):
     commands = [
       ('new', "Start a new conversation"),
       ('history', "Show previous conversations"),
+      ('search', "Search previous conversations"),
       ('retry', "Regenerate response for last message"),
+      ('stop', "Stop generating the response"),
       ('mode', "Select a mode for current chat and manage modes"),
       ('say', "Read out message sent by the bot by replying to it")
     ]
     await app.bot.set_my_commands(commands)
     logging.info("Set command list")
 
+    if expiry:
+      for chat_id, chat_data in app.chat_data.items():
+        expires_at = cast(ChatData, chat_data).get('conversation_expires_at')
+        if expires_at is not None:
+          expiry.schedule(chat_id, expires_at)
+
   async def post_shutdown(_: Application):
+    await gpt.close()
     if speech:
       await speech.close()
 
   app_builder = ApplicationBuilder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+  if owns_chat:
+    # Updates are forwarded to workers by the router process instead of being fetched by each of them
+    app_builder.updater(None)
   if options.data_dir:
-    persistence = PicklePersistence(os.path.join(options.data_dir, 'data'))
+    legacy_filepath = os.path.join(options.data_dir, 'data')
+    if options.storage == 'sqlite':
+      persistence = SQLitePersistence(os.path.join(options.data_dir, 'data.sqlite3'), legacy_filepath=legacy_filepath, owns_chat=owns_chat)
+    else:
+      persistence = ChatLogPersistence(os.path.join(options.data_dir, 'chats'), legacy_filepath=legacy_filepath, owns_chat=owns_chat)
     app_builder.persistence(persistence)
   app = app_builder.build()
 
@@ -272,15 +355,20 @@ def run(token: str, gpt: GPTClient, speech: SpeechClient|None, options: BotOptio
 
   app.add_handler(CommandHandler('start', create_callback(__start), block=False))
 
-  app.add_handler(CommandHandler('new', create_callback(__new_conversation), block=False))
+  app.add_handler(CommandHandler('new', create_callback(__new_conversation, serialized=True), block=False))
 
-  app.add_handler(CommandHandler('retry', create_callback(__retry_last_message), block=False))
-  app.add_handler(CallbackQueryHandler(create_callback(__retry_last_message), pattern=r'^/retry$', block=False))
+  app.add_handler(CommandHandler('retry', create_callback(__retry_last_message, serialized=True), block=False))
+  app.add_handler(CallbackQueryHandler(create_callback(__retry_last_message, serialized=True), pattern=r'^/retry$', block=False))
 
-  app.add_handler(MessageHandler(filters.COMMAND & filters.Regex(r'\/resume_\d+'), create_callback(__resume), block=False))
-  app.add_handler(CallbackQueryHandler(create_callback(__resume), pattern=r'^\/resume_\d+$', block=False))
+  app.add_handler(CommandHandler('stop', create_callback(__stop_generation), block=False))
+  app.add_handler(CallbackQueryHandler(create_callback(__stop_generation), pattern=r'^/stop$', block=False))
+
+  app.add_handler(MessageHandler(filters.COMMAND & filters.Regex(r'\/resume_\d+'), create_callback(__resume, serialized=True), block=False))
+  app.add_handler(CallbackQueryHandler(create_callback(__resume, serialized=True), pattern=r'^\/resume_\d+$', block=False))
 
   app.add_handler(CommandHandler('history', create_callback(__show_conversation_history), block=False))
+  app.add_handler(CallbackQueryHandler(create_callback(__show_conversation_history), pattern=r'^\/history_\d+$', block=False))
+  app.add_handler(CommandHandler('search', create_callback(__search_conversations), block=False))
   app.add_handler(CommandHandler('say', create_callback(__read_out_message), block=False))
 
   app.add_handler(CommandHandler('mode', create_callback(__set_mode), block=False))
@@ -303,9 +391,18 @@ def run(token: str, gpt: GPTClient, speech: SpeechClient|None, options: BotOptio
                     fallbacks=[CommandHandler('cancel', create_callback(__mode_add_cancel), block=False)],
                   ))
 
-  app.add_handler(MessageHandler(filters.TEXT & filters.UpdateType.MESSAGE & (~filters.COMMAND), create_callback(__handle_message), block=False))
-  app.add_handler(MessageHandler(filters.VOICE & filters.UpdateType.MESSAGE, create_callback(__handle_audio), block=False))
+  app.add_handler(MessageHandler(filters.TEXT & filters.UpdateType.MESSAGE & (~filters.COMMAND), create_callback(handle_message), block=False))
+  app.add_handler(MessageHandler(filters.VOICE & filters.UpdateType.MESSAGE, create_callback(__handle_audio, serialized=True), block=False))
+
+  return app
+
+def run(token: str, gpt: GPTClient, speech: SpeechClient|None, options: BotOptions):
+  if options.webhook and options.workers > 1:
+    host, port = options.webhook.host_and_port
+    run_workers(token, options.webhook.url, host, port, options.workers, lambda owns_chat: __build_application(token, gpt, speech, options, owns_chat))
+    return
 
+  app = __build_application(token, gpt, speech, options)
   if options.webhook:
     host, port = options.webhook.host_and_port
     app.run_webhook(
@@ -2,15 +2,97 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import time
 from dataclasses import dataclass, field
+from edits import EditScheduler
+from expiry import ExpiryScheduler
 from gpt import GPTClient
-from models import AssistantMessage, Conversation, Role, SystemMessage, UserMessage
-from speech import SpeechClient
+from history import HISTORY_PAGE_SIZE, ConversationIndex, SearchIndex
+from models import AssistantMessage, Conversation, Message, Role, SystemMessage, UserMessage, get_message_ids
+from speech import MAX_CONCURRENT_SYNTHESES, SpeechClient
+from speech_cache import SpeechCache, speech_key
+from titles import truncate
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import ExtBot
-from typing import TypedDict, cast, final
+from typing import Any, Awaitable, Callable, TypedDict, cast, final
 from uuid import uuid4
 
+MESSAGE_PAGE_LENGTH = 4000
+MAX_MESSAGE_LENGTH = 4096
+
+def with_note(page: str, note: str) -> str|None:
+  # Pages leave some room for a note, which doesn't fit after a page that is close to the limit
+  text = f"{page}\n\n{note}" if page else note
+  return text if len(text) <= MAX_MESSAGE_LENGTH else None
+
+def paginate(text: str) -> list[str]:
+  pages = []
+  while len(text) > MESSAGE_PAGE_LENGTH:
+    window = text[:MESSAGE_PAGE_LENGTH]
+    end = MESSAGE_PAGE_LENGTH
+    for separator in ('\n\n', '\n', '. ', ' '):
+      index = window.rfind(separator, MESSAGE_PAGE_LENGTH // 2)
+      if index != -1:
+        end = index + len(separator)
+        break
+
+    pages.append(text[:end].rstrip())
+    text = text[end:].lstrip()
+
+  if text or not pages:
+    pages.append(text)
+
+  return pages
+
+def trim_to_sentence(text: str) -> str:
+  end = max(text.rfind(separator) for separator in ('\n', '. ', '! ', '? ', '。', '！', '？'))
+  return text[:end + 1] if end != -1 else ''
+
+SPEECH_SEGMENT_LENGTH = 300
+
+class SpeechPipeline:
+  def __init__(self, synthesize: Callable[[str], Awaitable[Any]], send: Callable[[str, Any], Awaitable[Any]]):
+    self.__synthesize = synthesize
+    self.__send = send
+    self.__segments: asyncio.Queue[tuple[str, asyncio.Task]|None] = asyncio.Queue()
+    self.__synthesis_tasks: list[asyncio.Task] = []
+    self.__offset = 0
+    self.__sender = asyncio.create_task(self.__send_segments())
+
+  def feed(self, text: str):
+    # The first sentence is read out on its own to start playing early, and later ones are grouped into longer voices
+    min_length = SPEECH_SEGMENT_LENGTH if self.__synthesis_tasks else 1
+    segment = trim_to_sentence(text[self.__offset:])
+    if len(segment.strip()) >= min_length:
+      self.__add_segment(segment)
+
+  async def finish(self, text: str):
+    if text[self.__offset:].strip():
+      self.__add_segment(text[self.__offset:])
+    self.__segments.put_nowait(None)
+    await self.__sender
+
+  def cancel(self):
+    self.__sender.cancel()
+    for task in self.__synthesis_tasks:
+      task.cancel()
+
+  def __add_segment(self, segment: str):
+    self.__offset += len(segment)
+    task = asyncio.create_task(self.__synthesize(segment.strip()))
+    self.__synthesis_tasks.append(task)
+    self.__segments.put_nowait((segment.strip(), task))
+
+  async def __send_segments(self):
+    # Segments are synthesized concurrently but sent in order
+    while segment := await self.__segments.get():
+      text, task = segment
+      try:
+        await self.__send(text, await task)
+      except Exception as e:
+        logging.warning(f"Could not read out \"{text}\": {e}")
+
 @dataclass
 class ConversationMode:
   title: str
@@ -21,11 +103,16 @@ class ChatData(TypedDict):
   conversations: dict[int, Conversation]
   modes: dict[str, ConversationMode]
   current_mode_id: str|None
+  current_conversation_id: int|None
+  conversation_expires_at: float|None
 
 @dataclass
 class ChatState:
-  timeout_task: asyncio.Task|None = None
+  generation_task: asyncio.Task|None = None
   current_conversation: Conversation|None = None
+  conversation_index: ConversationIndex|None = None
+  search_index: SearchIndex|None = None
+  message_conversation_ids: dict[int, int]|None = None
 
   new_mode_title: str|None = None
   editing_mode: ConversationMode|None = None
@@ -35,6 +122,9 @@ class ChatContext:
   chat_id: int
   chat_state: ChatState
   __chat_data: ChatData
+  __load_messages: Callable[[int, Conversation], None]|None = None
+  __read_messages: Callable[[int, Conversation], list[Message]]|None = None
+  __read_message_ids: Callable[[int], dict[int, int]]|None = None
 
   @property
   def all_conversations(self) -> dict[int, Conversation]:
@@ -58,7 +148,65 @@ class ChatContext:
   def get_conversation(self, conversation_id: int) -> Conversation|None:
     if 'conversations' not in self.__chat_data:
       self.__chat_data['conversations'] = {}
-    return self.__chat_data['conversations'].get(conversation_id)
+    conversation = self.__chat_data['conversations'].get(conversation_id)
+    if conversation and self.__load_messages:
+      self.__load_messages(self.chat_id, conversation)
+    return conversation
+
+  def read_messages(self, conversation: Conversation) -> list[Message]:
+    if self.__read_messages:
+      return self.__read_messages(self.chat_id, conversation)
+    return conversation.messages
+
+  @property
+  def conversation_index(self) -> ConversationIndex:
+    # Indexes are built on first use and kept up to date as conversations change
+    if not self.chat_state.conversation_index:
+      self.chat_state.conversation_index = ConversationIndex(list(self.all_conversations.values()))
+    return self.chat_state.conversation_index
+
+  @property
+  def search_index(self) -> SearchIndex:
+    if not self.chat_state.search_index:
+      search_index = SearchIndex()
+      for conversation in self.all_conversations.values():
+        search_index.update(conversation, self.read_messages(conversation))
+      self.chat_state.search_index = search_index
+    return self.chat_state.search_index
+
+  @property
+  def message_conversation_ids(self) -> dict[int, int]:
+    if self.chat_state.message_conversation_ids is None:
+      # Ids of stored messages are read without reading the messages, and those in memory may be newer
+      message_conversation_ids = self.__read_message_ids(self.chat_id) if self.__read_message_ids else {}
+      for conversation in self.all_conversations.values():
+        for message_id in conversation.message_ids():
+          message_conversation_ids[message_id] = conversation.id
+      self.chat_state.message_conversation_ids = message_conversation_ids
+    return self.chat_state.message_conversation_ids
+
+  def find_message(self, message_id: int) -> tuple[Conversation, Message]|None:
+    current_conversation = self.chat_state.current_conversation
+    message = current_conversation.find_message(message_id) if current_conversation else None
+    if current_conversation and message:
+      return (current_conversation, message)
+
+    conversation_id = self.message_conversation_ids.get(message_id)
+    conversation = self.get_conversation(conversation_id) if conversation_id is not None else None
+    message = conversation.find_message(message_id) if conversation else None
+    return (conversation, message) if conversation and message else None
+
+  def index_messages(self, conversation: Conversation):
+    message_conversation_ids = self.chat_state.message_conversation_ids
+    if message_conversation_ids is None:
+      return
+
+    # Messages are indexed from the end until the ones indexed before
+    for message in reversed(conversation.messages):
+      if message.id in message_conversation_ids and message is not conversation.last_message:
+        break
+      for message_id in get_message_ids(message):
+        message_conversation_ids[message_id] = conversation.id
 
   def add_mode(self, mode: ConversationMode):
     if 'modes' not in self.__chat_data:
@@ -68,20 +216,33 @@ class ChatContext:
   def set_current_mode(self, mode: ConversationMode|None):
     self.__chat_data['current_mode_id'] = mode.id if mode else None
 
+  @property
+  def conversation_expires_at(self) -> float|None:
+    return self.__chat_data.get('conversation_expires_at')
+
+  def set_conversation_expiry(self, conversation: Conversation|None, expires_at: float|None):
+    self.__chat_data['current_conversation_id'] = conversation.id if conversation else None
+    self.__chat_data['conversation_expires_at'] = expires_at if conversation else None
+
+  def restore_current_conversation(self):
+    # The current conversation is only kept in memory, and is restored from the persisted expiry after a restart
+    conversation_id = self.__chat_data.get('current_conversation_id')
+    if conversation_id is not None and not self.chat_state.current_conversation:
+      self.chat_state.current_conversation = self.get_conversation(conversation_id)
+
 class ChatManager:
-  def __init__(self, *, gpt: GPTClient, speech: SpeechClient|None, bot: ExtBot, context: ChatContext, conversation_timeout: int|None):
+  def __init__(self, *, gpt: GPTClient, speech: SpeechClient|None, speech_cache: SpeechCache|None = None, edits: EditScheduler, expiry: ExpiryScheduler|None = None, bot: ExtBot, context: ChatContext, conversation_timeout: int|None, stream_by_sentence: bool = False):
     self.__gpt = gpt
     self.__speech = speech
+    self.__speech_cache = speech_cache
+    self.__edits = edits
+    self.__expiry = expiry
+    self.__stream_by_sentence = stream_by_sentence
     self.bot = bot
     self.context = context
     self.__conversation_timeout = conversation_timeout
 
   async def new_conversation(self):
-    chat_state = self.context.chat_state
-    timeout_job = chat_state.timeout_task
-    if timeout_job:
-      timeout_job.cancel()
-      chat_state.timeout_task = None
     await self.__expire_current_conversation()
 
     current_mode = self.context.current_mode
@@ -95,22 +256,23 @@ class ChatManager:
 
     logging.info(f"Started a new conversation for chat {self.context.chat_id}")
 
-  async def handle_message(self, *, text: str, user_message_id: int):
-    sent_message = await self.bot.send_message(chat_id=self.context.chat_id, text="Generating response...")
+  async def handle_message(self, *, text: str, user_message_id: int, read_out: bool = False):
+    stop_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Stop', callback_data='/stop')]])
+    sent_message = await self.bot.send_message(chat_id=self.context.chat_id, text="Generating response...", reply_markup=stop_markup)
 
     user_message = UserMessage(user_message_id, text)
 
     conversation = self.context.chat_state.current_conversation
     if conversation:
-      conversation.messages.append(user_message)
+      conversation.append_message(user_message)
     else:
       conversation = self.__create_conversation(user_message)
 
-    await self.__complete(conversation, sent_message.id)
+    await self.__complete(conversation, sent_message.id, read_out=read_out)
 
     return conversation
 
-  async def handle_audio(self, *, audio: bytearray, user_message_id: int):
+  async def handle_audio(self, *, audio_url: str, user_message_id: int):
     chat_id = self.context.chat_id
     if not self.__speech:
       await self.bot.send_message(chat_id=chat_id, text="Speech recognition is not available for this chat.")
@@ -119,7 +281,7 @@ class ChatManager:
     sent_message = await self.bot.send_message(chat_id=chat_id, text="Recognizing audio...", reply_to_message_id=user_message_id)
 
     try:
-      text = await self.__speech.speech_to_text(audio=audio)
+      text = await self.__speech.speech_to_text(audio=self.__speech.read_file(audio_url))
     except Exception as e:
       await self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message.id, text="Could not recognize audio")
       logging.warning(f"Could not recognize audio for chat {chat_id}: {e}")
@@ -132,12 +294,7 @@ class ChatManager:
       return
 
     await self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message.id, text=f"You said: \"{text}\"")
-    conversation = await self.handle_message(text=text, user_message_id=user_message_id)
-
-    if not conversation.last_message or not conversation.last_message.role == Role.ASSISTANT:
-      return
-
-    await self.__read_out_message(cast(AssistantMessage, conversation.last_message))
+    await self.handle_message(text=text, user_message_id=user_message_id, read_out=True)
 
   async def retry_last_message(self):
     chat_id = self.context.chat_id
@@ -146,16 +303,18 @@ class ChatManager:
       await self.bot.send_message(chat_id=chat_id, text="No conversation to retry")
       return
       
-    sent_message = await self.bot.send_message(chat_id=chat_id, text="Regenerating response...")
+    stop_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Stop', callback_data='/stop')]])
+    sent_message = await self.bot.send_message(chat_id=chat_id, text="Regenerating response...", reply_markup=stop_markup)
 
     if conversation.last_message and conversation.last_message.role == Role.ASSISTANT:
-      conversation.messages.pop()
+      conversation.pop_message()
 
     if not conversation.last_message or not conversation.last_message.role == Role.USER:
       await self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message.id, text="No message to retry")
       return
 
-    await self.__complete(conversation, sent_message.id)
+    # A cached answer would only be repeated, so the response is always generated again
+    await self.__complete(conversation, sent_message.id, use_cache=False)
 
   async def resume(self, *, conversation_id: int):
     chat_id = self.context.chat_id
@@ -170,40 +329,69 @@ class ChatManager:
     await self.bot.send_message(chat_id=chat_id, text=text)
 
     last_message = conversation.last_message
-    if last_message:
-      await self.bot.edit_message_text(chat_id=chat_id, message_id=last_message.id, text=last_message.content)
+    if last_message and last_message.role == Role.ASSISTANT:
+      last_message = cast(AssistantMessage, last_message)
+      await self.bot.edit_message_text(chat_id=chat_id, message_id=last_message.message_ids[-1], text=paginate(last_message.content)[-1])
 
     self.context.chat_state.current_conversation = conversation
 
-    self.__add_timeout_task()
+    self.__schedule_expiry()
 
     logging.info(f"Resumed conversation {conversation.id} for chat {chat_id}")
 
-  async def show_conversation_history(self):
-    conversations = list(self.context.all_conversations.values())
-    text = '\n'.join(f"[/resume_{conversation.id}] {conversation.title} ({conversation.started_at:%Y-%m-%d %H:%M})" for conversation in conversations)
+  async def show_conversation_history(self, *, page: int = 0, sent_message_id: int|None = None):
+    conversation_index = self.context.conversation_index
+    page = min(max(page, 0), conversation_index.page_count - 1)
+    conversations = self.context.all_conversations
+    page_conversations = [conversations[conversation_id] for conversation_id in conversation_index.page(page) if conversation_id in conversations]
+
+    text = self.__format_conversations(page_conversations) or "No conversation history"
+    if conversation_index.page_count > 1:
+      text += f"\n\nPage {page + 1} of {conversation_index.page_count}"
+
+    buttons = []
+    if page > 0:
+      buttons.append(InlineKeyboardButton("Newer", callback_data=f"/history_{page - 1}"))
+    if page < conversation_index.page_count - 1:
+      buttons.append(InlineKeyboardButton("Older", callback_data=f"/history_{page + 1}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    if sent_message_id:
+      await self.bot.edit_message_text(chat_id=self.context.chat_id, message_id=sent_message_id, text=text, reply_markup=reply_markup)
+    else:
+      await self.bot.send_message(chat_id=self.context.chat_id, text=text, reply_markup=reply_markup)
+
+    logging.info(f"Showed page {page} of conversation history for chat {self.context.chat_id}")
 
-    if not text:
-      text = "No conversation history"
+  async def search_conversations(self, query: str):
+    chat_id = self.context.chat_id
+    search_index = self.context.search_index
+    conversations = self.context.all_conversations
+
+    # Titles are generated in the background, so they are indexed when searching
+    for conversation in conversations.values():
+      search_index.update(conversation)
 
-    logging.info(f"Sending history for chat {self.context.chat_id}: {text}")
+    matches = sorted((conversations[conversation_id] for conversation_id in search_index.search(query) if conversation_id in conversations), key=lambda conversation: conversation.started_at, reverse=True)
+    if not matches:
+      await self.bot.send_message(chat_id=chat_id, text=f"No conversation found for \"{query}\"")
+      return
 
-    await self.bot.send_message(chat_id=self.context.chat_id, text=text)
+    text = self.__format_conversations(matches[:HISTORY_PAGE_SIZE])
+    if len(matches) > HISTORY_PAGE_SIZE:
+      text += f"\n\nShowing the latest {HISTORY_PAGE_SIZE} of {len(matches)} conversations found"
+    await self.bot.send_message(chat_id=chat_id, text=text)
 
-    logging.info(f"Showed conversation history for chat {self.context.chat_id}")
+    logging.info(f"Found {len(matches)} conversations for chat {chat_id}")
 
   async def read_out_message(self, *, message_id: int):
     chat_id = self.context.chat_id
 
-    current_conversation = self.context.chat_state.current_conversation
-    if not current_conversation:
-      await self.bot.send_message(chat_id=chat_id, text="Can only read out messages in current conversation.")
-      return
-
-    message = next((message for message in current_conversation.messages if message.id == message_id), None)
-    if not message:
+    found = self.context.find_message(message_id)
+    if not found:
       await self.bot.send_message(chat_id=chat_id, text="Could not find that message.")
       return
+    _, message = found
 
     if message.role != Role.ASSISTANT:
       await self.bot.send_message(chat_id=chat_id, text="Can only read out messages sent by the bot.")
@@ -211,6 +399,15 @@ class ChatManager:
 
     await self.__read_out_message(cast(AssistantMessage, message))
 
+  def stop_generation(self) -> bool:
+    generation_task = self.context.chat_state.generation_task
+    if not generation_task or generation_task.done():
+      return False
+
+    generation_task.cancel()
+    logging.info(f"Stopping generation for chat {self.context.chat_id}")
+    return True
+
   async def list_modes_for_selection(self):
     modes = list(self.context.modes.values())
 
@@ -313,44 +510,107 @@ class ChatManager:
     text = f"Mode \"{mode.title}\" deleted."
     await self.bot.edit_message_text(chat_id=self.context.chat_id, message_id=sent_message_id, text=text)
 
-  async def __complete(self, conversation: Conversation, sent_message_id: int):
+  async def __complete(self, conversation: Conversation, sent_message_id: int, read_out: bool = False, use_cache: bool = True):
     chat_id = self.context.chat_id
-    try:
-      system_prompt = SystemMessage(self.context.current_mode.prompt) if self.context.current_mode else None
-      final_message = None
+    chat_state = self.context.chat_state
+    stop_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Stop', callback_data='/stop')]])
+    final_message: AssistantMessage|None = None
+
+    # Each sentence is read out as soon as it's generated, instead of after the whole response.
+    # The chunks of all the sentences share one semaphore, so that the reply as a whole stays within the synthesis limit.
+    speech_pipeline = None
+    if read_out and self.__speech:
+      synthesis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SYNTHESES)
+      speech_pipeline = SpeechPipeline(lambda text: self.__synthesize(text, semaphore=synthesis_semaphore), lambda text, voice: self.__send_voice(text, voice, sent_message_id))
 
-      last_update_task = None
-      last_update_time = asyncio.get_running_loop().time()
+    async def stream(system_prompt: SystemMessage|None):
+      nonlocal final_message
 
-      async for message in self.__gpt.complete(conversation, cast(UserMessage, conversation.last_message), sent_message_id, system_prompt):
+      async for message in self.__gpt.complete(chat_id, conversation, cast(UserMessage, conversation.last_message), sent_message_id, system_prompt, use_cache=use_cache):
         final_message = message
+        pages = paginate(message.content)
+
+        # Only the last page changes while streaming, so earlier pages are finalized once a new page starts
+        while len(message.message_ids) < len(pages):
+          page_index = len(message.message_ids)
+          self.__edits.submit(self.bot, chat_id, message.message_ids[-1], pages[page_index - 1])
+          sent_page = await self.bot.send_message(chat_id=chat_id, text="Generating...", reply_markup=stop_markup)
+          message.continuation_ids.append(sent_page.id)
+
+        streamed_text = trim_to_sentence(pages[-1]) if self.__stream_by_sentence else pages[-1]
+        if streamed_text.strip():
+          self.__edits.submit(self.bot, chat_id, message.message_ids[-1], streamed_text.rstrip() + '\n\nGenerating...', reply_markup=stop_markup)
 
-        if last_update_task and not last_update_task.done():
-          continue
+        if speech_pipeline:
+          speech_pipeline.feed(message.content)
 
-        now = asyncio.get_running_loop().time()
-        if now - last_update_time < 2:
-          continue
+    try:
+      system_prompt = SystemMessage(self.context.current_mode.prompt) if self.context.current_mode else None
 
-        last_update_time = now
-        last_update_task = asyncio.create_task(self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message_id, text=message.content + '\n\nGenerating...'))
+      generation_task = asyncio.create_task(stream(system_prompt))
+      chat_state.generation_task = generation_task
+      try:
+        await generation_task
+        is_stopped = False
+      except asyncio.CancelledError:
+        current_task = asyncio.current_task()
+        if current_task and current_task.cancelling():
+          raise
+        is_stopped = True
+        logging.info(f"Stopped generating response for chat {chat_id}")
+      finally:
+        if chat_state.generation_task is generation_task:
+          chat_state.generation_task = None
 
       if final_message:
-        await self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message_id, text=final_message.content)
+        final_text = paginate(final_message.content)[-1] + ("\n\nStopped." if is_stopped else "")
+        await self.__edits.edit(self.bot, chat_id, final_message.message_ids[-1], final_text)
+      elif is_stopped:
+        retry_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Retry', callback_data='/retry')]])
+        await self.__edits.edit(self.bot, chat_id, sent_message_id, "Stopped.", reply_markup=retry_markup)
+
+      if speech_pipeline and final_message:
+        await speech_pipeline.finish(final_message.content)
 
       logging.info(f"Replied chat {chat_id} with message '{final_message}'")
     except TimeoutError:
-      retry_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Retry', callback_data='/retry')]])
-      await self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message_id, text="Generation timed out.", reply_markup=retry_markup)
+      await self.__show_failure(final_message, sent_message_id, "Generation timed out.")
       logging.info(f"Timed out generating response for chat {chat_id}")
     except Exception as e:
-      retry_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Retry', callback_data='/retry')]])
-      await self.bot.edit_message_text(chat_id=chat_id, message_id=sent_message_id, text="Error generating response", reply_markup=retry_markup)
+      await self.__show_failure(final_message, sent_message_id, "Error generating response")
       logging.error(f"Error generating response for chat {chat_id}: {e}")
-    
+    finally:
+      if speech_pipeline:
+        speech_pipeline.cancel()
+
     self.context.chat_state.current_conversation = conversation
+    if self.context.chat_state.search_index:
+      self.context.chat_state.search_index.update(conversation, conversation.messages)
+    self.context.index_messages(conversation)
+
+    self.__schedule_expiry()
+
+  async def __show_failure(self, final_message: AssistantMessage|None, sent_message_id: int, note: str):
+    # The note goes on the last page, so that no page is left showing that it's being generated
+    retry_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Retry', callback_data='/retry')]])
+    if not final_message:
+      await self.__edits.edit(self.bot, self.context.chat_id, sent_message_id, note, reply_markup=retry_markup)
+      return
+
+    page = paginate(final_message.content)[-1]
+    await self.__edits.edit(self.bot, self.context.chat_id, final_message.message_ids[-1], with_note(page, note) or page, reply_markup=retry_markup)
 
-    self.__add_timeout_task()
+  async def expire_conversation(self) -> float|None:
+    # The conversation may have been continued after the expiry was due and before this chat's turn came, in which case the new deadline is returned
+    expires_at = self.context.conversation_expires_at
+    if expires_at is None:
+      return None
+    if expires_at > time.time():
+      return expires_at
+
+    self.context.restore_current_conversation()
+    await self.__expire_current_conversation()
+    return None
 
   async def __read_out_message(self, message: AssistantMessage):
     chat_id = self.context.chat_id
@@ -359,39 +619,63 @@ class ChatManager:
       await self.bot.send_message(chat_id=chat_id, text="Speech recognition is not available for this chat.")
       return
 
-    logging.info(f"Generating audio for chat {chat_id} for message \"{message.content}\"")
-
     try:
-      speech_content = await self.__speech.text_to_speech(text=message.content)
+      voice = await self.__synthesize(message.content)
     except Exception as e:
       await self.bot.send_message(chat_id=chat_id, text="Could not generate audio", reply_to_message_id=message.id)
       logging.warning(f"Could not generate audio for chat {chat_id}: {e}")
       return
 
-    await self.bot.send_voice(chat_id=chat_id, voice=speech_content, reply_to_message_id=message.id)
+    await self.__send_voice(message.content, voice, message.id)
 
-  def __add_timeout_task(self):
-    chat_state = self.context.chat_state
-    last_task = chat_state.timeout_task
-    if last_task:
-      last_task.cancel()
-      chat_state.timeout_task = None
+  async def __synthesize(self, text: str, *, reuse_upload: bool = True, semaphore: asyncio.Semaphore|None = None) -> bytes|str:
+    speech = cast(SpeechClient, self.__speech)
+    key = speech_key(speech.voice_name, text)
+    speech_cache = self.__speech_cache
 
-    timeout = self.__conversation_timeout
-    if not timeout:
-      return
+    # A voice that has been uploaded before is sent again by its file ID, without being synthesized or uploaded
+    file_id = speech_cache.get_file_id(key) if speech_cache and reuse_upload else None
+    if file_id:
+      return file_id
+
+    speech_content = speech_cache.get_audio(key) if speech_cache else None
+    if not speech_content:
+      logging.info(f"Generating audio for chat {self.context.chat_id} for \"{text}\"")
+      speech_content = await speech.text_to_speech(text=text, semaphore=semaphore)
+      if speech_cache:
+        speech_cache.put(key, speech_content)
+
+    return speech_content
 
-    async def time_out_current_conversation():
-      await asyncio.sleep(timeout)
-      chat_state.timeout_task = None
+  async def __send_voice(self, text: str, voice: bytes|str, reply_to_message_id: int):
+    chat_id = self.context.chat_id
+
+    try:
+      sent_message = await self.bot.send_voice(chat_id=chat_id, voice=voice, reply_to_message_id=reply_to_message_id)
+    except BadRequest as e:
+      if not isinstance(voice, str):
+        raise
+      logging.warning(f"Could not send cached audio {voice} for chat {chat_id}: {e}")
+      sent_message = await self.bot.send_voice(chat_id=chat_id, voice=await self.__synthesize(text, reuse_upload=False), reply_to_message_id=reply_to_message_id)
+
+    if self.__speech_cache and sent_message.voice:
+      self.__speech_cache.set_file_id(speech_key(cast(SpeechClient, self.__speech).voice_name, text), sent_message.voice.file_id)
 
-      await self.__expire_current_conversation()
+  def __schedule_expiry(self):
+    conversation = self.context.chat_state.current_conversation
+    if not self.__expiry or not self.__conversation_timeout or not conversation:
+      return
 
-    chat_state.timeout_task = asyncio.create_task(time_out_current_conversation())
+    expires_at = time.time() + self.__conversation_timeout
+    self.context.set_conversation_expiry(conversation, expires_at)
+    self.__expiry.schedule(self.context.chat_id, expires_at)
 
   async def __expire_current_conversation(self):
     chat_state = self.context.chat_state
     current_conversation = chat_state.current_conversation
+    if self.__expiry:
+      self.__expiry.cancel(self.context.chat_id)
+    self.context.set_conversation_expiry(None, None)
     if not current_conversation:
       return
 
@@ -402,20 +686,29 @@ class ChatManager:
       return
     last_message = cast(AssistantMessage, last_message)
 
-    new_text = last_message.content + f"\n\nThis conversation has expired and it was about \"{current_conversation.title}\". A new conversation has started."
+    note = f"This conversation has expired and it was about \"{current_conversation.title}\". A new conversation has started."
     resume_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Resume this conversation", callback_data=f"/resume_{current_conversation.id}")]])
-    await self.bot.edit_message_text(chat_id=self.context.chat_id, message_id=last_message.id, text=new_text, reply_markup=resume_markup)
+    new_text = with_note(paginate(last_message.content)[-1], note)
+    if new_text:
+      await self.__edits.edit(self.bot, self.context.chat_id, last_message.message_ids[-1], new_text, reply_markup=resume_markup)
+    else:
+      await self.bot.send_message(chat_id=self.context.chat_id, text=note, reply_markup=resume_markup, reply_to_message_id=last_message.message_ids[-1])
 
     logging.info(f"Conversation {current_conversation.id} timed out")
 
   def __create_conversation(self, user_message: UserMessage) -> Conversation:
     current_conversation = self.context.chat_state.current_conversation
     if current_conversation:
-      current_conversation.messages.append(user_message)
+      current_conversation.append_message(user_message)
       return current_conversation
     else:
       conversations = self.context.all_conversations
       conversation = self.__gpt.new_conversation(len(conversations), user_message)
       conversations[conversation.id] = conversation
+      if self.context.chat_state.conversation_index:
+        self.context.chat_state.conversation_index.add(conversation)
 
       return conversation
+
+  def __format_conversations(self, conversations: list[Conversation]) -> str:
+    return '\n'.join(f"[/resume_{conversation.id}] {truncate(conversation.title or 'Untitled', 100)} ({conversation.started_at:%Y-%m-%d %H:%M})" for conversation in conversations)
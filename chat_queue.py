@@ -0,0 +1,48 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+class ChatQueue:
+  def __init__(self, *, merge_messages: bool = False):
+    self.__merge_messages = merge_messages
+    self.__tasks: dict[int, asyncio.Task] = {}
+    self.__pending_messages: dict[int, list[tuple[str, int]]] = {}
+
+  async def run(self, chat_id: int, operation: Callable[[], Awaitable[Any]]) -> Any:
+    previous_task = self.__tasks.get(chat_id)
+
+    async def task():
+      if previous_task:
+        try:
+          await previous_task
+        except Exception as e:
+          logging.warning(f"Error {e} in previous task for chat {chat_id}")
+      return await operation()
+
+    current_task = asyncio.create_task(task())
+    self.__tasks[chat_id] = current_task
+    try:
+      return await current_task
+    finally:
+      if self.__tasks.get(chat_id) is current_task:
+        del self.__tasks[chat_id]
+
+  async def run_message(self, chat_id: int, text: str, message_id: int, handle: Callable[[str, int], Awaitable[Any]]) -> Any:
+    if not self.__merge_messages:
+      return await self.run(chat_id, lambda: handle(text, message_id))
+
+    pending_messages = self.__pending_messages.get(chat_id)
+    if pending_messages is not None:
+      pending_messages.append((text, message_id))
+      logging.info(f"Queued message {message_id} for chat {chat_id} to be merged with {len(pending_messages) - 1} other messages")
+      return
+
+    pending_messages = [(text, message_id)]
+    self.__pending_messages[chat_id] = pending_messages
+
+    async def handle_pending_messages():
+      del self.__pending_messages[chat_id]
+      merged_text = '\n\n'.join(text for text, _ in pending_messages)
+      return await handle(merged_text, pending_messages[-1][1])
+
+    return await self.run(chat_id, handle_pending_messages)
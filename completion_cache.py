@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from models import Message
+
+def completion_key(deployment: str, messages: list[Message]) -> str:
+  # Whitespace differences don't change the answer, so they shouldn't miss the cache
+  normalized_messages = [(message.role.value, ' '.join(message.content.split())) for message in messages]
+  return hashlib.sha256(json.dumps([deployment, normalized_messages]).encode()).hexdigest()
+
+class CompletionCache:
+  def __init__(self, *, max_entries: int, ttl: float, filepath: str|None = None):
+    self.__max_entries = max_entries
+    self.__ttl = ttl
+    self.__filepath = filepath
+    self.__entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+    self.__connection: sqlite3.Connection|None = None
+
+  @property
+  def __database(self) -> sqlite3.Connection|None:
+    if self.__filepath and not self.__connection:
+      self.__connection = sqlite3.connect(self.__filepath)
+      self.__connection.execute('PRAGMA journal_mode=WAL')
+      self.__connection.execute('PRAGMA synchronous=NORMAL')
+      self.__connection.execute('PRAGMA busy_timeout=5000')
+      self.__connection.execute('CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)')
+    return self.__connection
+
+  def get(self, key: str) -> str|None:
+    now = time.time()
+
+    entry = self.__entries.get(key)
+    if not entry and self.__database:
+      row = self.__database.execute('SELECT content, created_at FROM completions WHERE key = ?', (key,)).fetchone()
+      entry = tuple(row) if row else None
+
+    if not entry:
+      return None
+
+    content, created_at = entry
+    if now - created_at > self.__ttl:
+      self.__remove(key)
+      return None
+
+    self.__remember(key, entry)
+    if self.__database:
+      with self.__database:
+        self.__database.execute('UPDATE completions SET used_at = ? WHERE key = ?', (now, key))
+
+    return content
+
+  def put(self, key: str, content: str):
+    now = time.time()
+    self.__remember(key, (content, now))
+
+    if self.__database:
+      with self.__database:
+        self.__database.execute('INSERT OR REPLACE INTO completions (key, content, created_at, used_at) VALUES (?, ?, ?, ?)', (key, content, now, now))
+        self.__database.execute('DELETE FROM completions WHERE created_at < ? OR key NOT IN (SELECT key FROM completions ORDER BY used_at DESC LIMIT ?)', (now - self.__ttl, self.__max_entries))
+
+    logging.debug(f"Cached completion {key}")
+
+  def close(self):
+    if self.__connection:
+      self.__connection.close()
+      self.__connection = None
+
+  def __remember(self, key: str, entry: tuple[str, float]):
+    self.__entries[key] = entry
+    self.__entries.move_to_end(key)
+    while len(self.__entries) > self.__max_entries:
+      self.__entries.popitem(last=False)
+
+  def __remove(self, key: str):
+    self.__entries.pop(key, None)
+    if self.__database:
+      with self.__database:
+        self.__database.execute('DELETE FROM completions WHERE key = ?', (key,))
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter
+from typing import Any
+
+@dataclass
+class _PendingEdit:
+  bot: Bot
+  chat_id: int
+  message_id: int
+  text: str
+  kwargs: dict[str, Any]
+  submitted_at: float
+  waiters: list[asyncio.Future] = field(default_factory=list)
+
+  @property
+  def key(self) -> tuple[int, int]:
+    return (self.chat_id, self.message_id)
+
+  @property
+  def visible_content(self) -> tuple:
+    return ('\n'.join(line.rstrip() for line in self.text.strip().splitlines()), self.kwargs)
+
+SENT_CONTENT_CACHE_SIZE = 1024
+
+class EditScheduler:
+  def __init__(self, *, global_rate: float = 20, chat_rate: float = 1):
+    self.__global_interval = 1 / global_rate
+    self.__chat_interval = 1 / chat_rate
+    self.__pending: dict[tuple[int, int], _PendingEdit] = {}
+    self.__in_flight: set[tuple[int, int]] = set()
+    self.__sent_contents: OrderedDict[tuple[int, int], tuple] = OrderedDict()
+    self.__chat_ready_times: dict[int, float] = {}
+    self.__global_ready_time = 0.0
+    self.__wakeup = asyncio.Event()
+    self.__task: asyncio.Task|None = None
+
+  def submit(self, bot: Bot, chat_id: int, message_id: int, text: str, **kwargs):
+    self.__enqueue(_PendingEdit(bot, chat_id, message_id, text, kwargs, asyncio.get_running_loop().time()))
+
+  async def edit(self, bot: Bot, chat_id: int, message_id: int, text: str, **kwargs):
+    future = asyncio.get_running_loop().create_future()
+    self.__enqueue(_PendingEdit(bot, chat_id, message_id, text, kwargs, asyncio.get_running_loop().time(), [future]))
+    await future
+
+  def __enqueue(self, edit: _PendingEdit):
+    superseded_edit = self.__pending.get(edit.key)
+    if superseded_edit:
+      edit.waiters = superseded_edit.waiters + edit.waiters
+      edit.submitted_at = superseded_edit.submitted_at
+    elif edit.key not in self.__in_flight and self.__sent_contents.get(edit.key) == edit.visible_content:
+      self.__resolve(edit, None)
+      return
+    self.__pending[edit.key] = edit
+
+    self.__wakeup.set()
+    if not self.__task or self.__task.done():
+      self.__task = asyncio.create_task(self.__run())
+
+  async def __run(self):
+    loop = asyncio.get_running_loop()
+
+    while self.__pending:
+      self.__wakeup.clear()
+      now = loop.time()
+
+      ready_edits = [edit for edit in self.__pending.values() if edit.key not in self.__in_flight and self.__chat_ready_times.get(edit.chat_id, 0) <= now]
+      if not ready_edits or self.__global_ready_time > now:
+        waiting_times = [self.__chat_ready_times.get(edit.chat_id, 0) for edit in self.__pending.values() if edit.key not in self.__in_flight]
+        wake_time = max(min(waiting_times, default=now + 1), self.__global_ready_time)
+        try:
+          await asyncio.wait_for(self.__wakeup.wait(), max(wake_time - now, 0.01))
+        except TimeoutError:
+          pass
+        continue
+
+      edit = min(ready_edits, key=lambda edit: edit.submitted_at)
+      del self.__pending[edit.key]
+
+      if self.__sent_contents.get(edit.key) == edit.visible_content:
+        self.__resolve(edit, None)
+        continue
+
+      self.__in_flight.add(edit.key)
+
+      # Share the global budget between chats that are waiting, and edit as often as the per-chat budget allows when idle
+      active_chat_count = len({edit.chat_id for edit in self.__pending.values()}) + 1
+      self.__chat_ready_times[edit.chat_id] = now + max(self.__chat_interval, active_chat_count * self.__global_interval)
+      self.__global_ready_time = now + self.__global_interval
+
+      asyncio.create_task(self.__send(edit))
+
+    self.__chat_ready_times = {chat_id: ready_time for chat_id, ready_time in self.__chat_ready_times.items() if ready_time > loop.time()}
+
+  async def __send(self, edit: _PendingEdit):
+    try:
+      await edit.bot.edit_message_text(chat_id=edit.chat_id, message_id=edit.message_id, text=edit.text, **edit.kwargs)
+      error = None
+    except RetryAfter as e:
+      logging.warning(f"Edits of chat {edit.chat_id} are rate limited for {e.retry_after} seconds")
+
+      self.__chat_ready_times[edit.chat_id] = asyncio.get_running_loop().time() + e.retry_after
+      self.__in_flight.discard(edit.key)
+      if edit.key in self.__pending:
+        self.__pending[edit.key].waiters[:0] = edit.waiters
+        self.__wakeup.set()
+      else:
+        self.__enqueue(edit)
+      return
+    except BadRequest as e:
+      error = None if 'not modified' in e.message else e
+    except Exception as e:
+      error = e
+    finally:
+      self.__in_flight.discard(edit.key)
+      self.__wakeup.set()
+
+    if error:
+      logging.warning(f"Could not edit message {edit.message_id} of chat {edit.chat_id}: {error}")
+    else:
+      self.__sent_contents[edit.key] = edit.visible_content
+      self.__sent_contents.move_to_end(edit.key)
+      if len(self.__sent_contents) > SENT_CONTENT_CACHE_SIZE:
+        self.__sent_contents.popitem(last=False)
+
+    self.__resolve(edit, error)
+
+  def __resolve(self, edit: _PendingEdit, error: Exception|None):
+    for waiter in edit.waiters:
+      if waiter.done():
+        continue
+      if error:
+        waiter.set_exception(error)
+      else:
+        waiter.set_result(None)
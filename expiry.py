@@ -0,0 +1,70 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+EXPIRY_BATCH_WINDOW = 1
+HEAP_COMPACTION_MIN_SIZE = 64
+
+class ExpiryScheduler:
+  def __init__(self, expire: Callable[[list[int]], Awaitable[Any]], *, batch_window: float = EXPIRY_BATCH_WINDOW):
+    self.__expire = expire
+    self.__batch_window = batch_window
+    # Deadlines are wall clock times, so that the ones persisted before a restart still apply
+    self.__deadlines: dict[int, float] = {}
+    self.__heap: list[tuple[float, int]] = []
+    self.__wakeup = asyncio.Event()
+    self.__task: asyncio.Task|None = None
+
+  def schedule(self, chat_id: int, deadline: float):
+    self.__deadlines[chat_id] = deadline
+    heapq.heappush(self.__heap, (deadline, chat_id))
+    if len(self.__heap) > max(2 * len(self.__deadlines), HEAP_COMPACTION_MIN_SIZE):
+      self.__heap = [(deadline, chat_id) for chat_id, deadline in self.__deadlines.items()]
+      heapq.heapify(self.__heap)
+
+    self.__wakeup.set()
+    if not self.__task or self.__task.done():
+      self.__task = asyncio.create_task(self.__run())
+
+  def cancel(self, chat_id: int):
+    # The entry in the heap is skipped when it's popped
+    self.__deadlines.pop(chat_id, None)
+
+  async def __run(self):
+    while self.__deadlines:
+      self.__wakeup.clear()
+      self.__discard_cancelled()
+
+      # Waking up a moment after the earliest deadline lets chats expiring around the same time be expired together
+      now = time.time()
+      wake_time = self.__heap[0][0] + self.__batch_window
+      if wake_time > now:
+        try:
+          await asyncio.wait_for(self.__wakeup.wait(), wake_time - now)
+        except TimeoutError:
+          pass
+        continue
+
+      batch = []
+      while self.__heap and self.__heap[0][0] <= now:
+        deadline, chat_id = heapq.heappop(self.__heap)
+        if self.__deadlines.get(chat_id) == deadline:
+          del self.__deadlines[chat_id]
+          batch.append(chat_id)
+
+      if batch:
+        asyncio.create_task(self.__expire_batch(batch))
+
+    self.__heap.clear()
+
+  def __discard_cancelled(self):
+    while self.__heap and self.__deadlines.get(self.__heap[0][1]) != self.__heap[0][0]:
+      heapq.heappop(self.__heap)
+
+  async def __expire_batch(self, chat_ids: list[int]):
+    try:
+      await self.__expire(chat_ids)
+    except Exception as e:
+      logging.error(f"Error expiring conversations of {len(chat_ids)} chats: {e}")
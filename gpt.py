@@ -1,10 +1,15 @@
 import asyncio
 from dataclasses import dataclass, field
+import json
 import logging
 import openai
-from aiohttp import ClientSession
-from models import AssistantMessage, Conversation, Message, SystemMessage, UserMessage
-from typing import cast
+from typing import AsyncGenerator, Hashable
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
+from backends import Backend, BackendLease, BackendOptions, BackendPool
+from completion_cache import CompletionCache, completion_key
+from models import AssistantMessage, Conversation, Message, Role, SystemMessage, UserMessage, estimate_token_count
+from rate_limits import Priority, RequestScheduler
+from titles import TitleBatcher, heuristic_title, title_excerpt
 
 @dataclass
 class GPTOptions:
@@ -12,86 +17,379 @@ class GPTOptions:
   model_name: str = 'gpt-3.5-turbo'
   azure_endpoint: str|None = None
   max_message_count: int|None = None
+  max_context_tokens: int|None = None
+  summarize_history: bool = False
+  max_connections: int = 100
+  keepalive_timeout: float = 60
+  requests_per_minute: int|None = None
+  tokens_per_minute: int|None = None
+  completion_cache_size: int = 0
+  completion_cache_ttl: float = 86400
+  completion_cache_filepath: str|None = None
+  title_model_name: str|None = None
+  local_titles: bool = False
+  additional_backends: list[BackendOptions] = field(default_factory=list)
+
+MODEL_CONTEXT_TOKENS = {
+  'gpt-3.5-turbo': 4096,
+  'gpt-3.5-turbo-16k': 16384,
+  'gpt-4': 8192,
+  'gpt-4-32k': 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+REPLY_TOKEN_RESERVE = 1024
+SUMMARY_WORD_LIMIT = 200
+
+OPENAI_API_BASE = 'https://api.openai.com/v1'
+AZURE_API_VERSION = '2023-03-15-preview'
+DNS_CACHE_TTL = 300
+REQUEST_TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+FIRST_TOKEN_HEDGE_DELAY = 10
+FIRST_TOKEN_TIMEOUT = 60
+TOKEN_TIMEOUT = 30
+
+def get_context_token_budget(model_name: str) -> int:
+  for name in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+    if model_name.startswith(name):
+      return MODEL_CONTEXT_TOKENS[name] - REPLY_TOKEN_RESERVE
+  return DEFAULT_CONTEXT_TOKENS - REPLY_TOKEN_RESERVE
 
 class GPTClient:
   def __init__(self, *, options: GPTOptions):
-    self.__model_name = options.model_name
     self.__max_message_count = options.max_message_count
-    self.__is_azure = options.azure_endpoint is not None
+    self.__context_token_budget = options.max_context_tokens or get_context_token_budget(options.model_name)
+    self.__summarize_history = options.summarize_history
+    self.__summarizing_conversations: set[int] = set()
+    self.__backends = BackendPool([BackendOptions(options.api_key, options.model_name, options.azure_endpoint)] + options.additional_backends)
+    self.__max_connections = options.max_connections
+    self.__keepalive_timeout = options.keepalive_timeout
+    self.__session: ClientSession|None = None
+    self.__scheduler = RequestScheduler(requests_per_minute=options.requests_per_minute, tokens_per_minute=options.tokens_per_minute)
+    self.__local_titles = options.local_titles
+    self.__title_batcher = TitleBatcher(lambda messages: self.__request(messages, 'titles', Priority.BACKGROUND, model_name=options.title_model_name))
+    self.__completion_cache = CompletionCache(max_entries=options.completion_cache_size, ttl=options.completion_cache_ttl, filepath=options.completion_cache_filepath) if options.completion_cache_size else None
 
-    openai.api_key = options.api_key
-    if options.azure_endpoint:
-      openai.api_base = options.azure_endpoint
-      openai.api_type = 'azure'
-      openai.api_version = "2023-03-15-preview"
+  async def close(self):
+    if self.__session:
+      await self.__session.close()
+      self.__session = None
+    if self.__completion_cache:
+      self.__completion_cache.close()
 
-    openai.aiosession.set(ClientSession(trust_env=True))
-
-  async def complete(self, conversation: Conversation, user_message: UserMessage, sent_msg_id: int, system_message: SystemMessage|None):
+  async def complete(self, chat_id: int, conversation: Conversation, user_message: UserMessage, sent_msg_id: int, system_message: SystemMessage|None, *, use_cache: bool = True):
     logging.info(f"Completing message for conversation {conversation.id}, message: '{user_message}'")
 
     logging.debug(f"Current conversation for chat {conversation.id}: {conversation}")
 
     assistant_message = None
+    context = self.__build_context(conversation, system_message)
+
+    # Only the first question of a conversation is cached, since a later one rarely has the same history.
+    # Answers are cached per backend deployment, and an answer from any of the configured ones is reused.
+    is_cacheable = bool(self.__completion_cache) and len([message for message in context if message.role != Role.SYSTEM]) == 1
+    cached_content = None
+    if self.__completion_cache and is_cacheable and use_cache:
+      for backend in self.__backends.backends:
+        cached_content = self.__completion_cache.get(completion_key(repr(backend), context))
+        if cached_content:
+          break
+
+    answering_backends: list[Backend] = []
+    if cached_content:
+      logging.info(f"Replaying cached completion for conversation {conversation.id}")
+      chunks = self.__replay(cached_content)
+    else:
+      chunks = self.__stream(context, chat_id, Priority.INTERACTIVE, answering_backends)
+
+    try:
+      async for chunk in chunks:
+        if not assistant_message:
+          assistant_message = AssistantMessage(sent_msg_id, '', user_message.id)
+          conversation.append_message(assistant_message)
 
-    async for chunk in self.__stream(([system_message] if system_message else []) + conversation.messages):
-      if not assistant_message:
-        assistant_message = AssistantMessage(sent_msg_id, '', user_message.id)
-        conversation.messages.append(assistant_message)
+        assistant_message.content += chunk
+        yield assistant_message
 
-      assistant_message.content += chunk
-      yield assistant_message
+      if self.__completion_cache and is_cacheable and answering_backends and assistant_message:
+        self.__completion_cache.put(completion_key(repr(answering_backends[0]), context), assistant_message.content)
+    finally:
+      # A partial response is kept when the generation is stopped
+      if assistant_message:
+        self.__finish_completion(chat_id, conversation, system_message)
+
+    logging.info(f"Completed message for chat {conversation.id}, message: '{assistant_message}'")
 
+  def __finish_completion(self, chat_id: int, conversation: Conversation, system_message: SystemMessage|None):
     if conversation.title is None and len(conversation.messages) < 3:
       async def set_title(conversation: Conversation):
-        prompt = 'You are a title generator. You will receive one or multiple messages of a conversation. You will reply with only the title of the conversation without any punctuation mark either at the begining or the end.'
-        messages = [SystemMessage(prompt)] + conversation.messages
+        title = None
+        if not self.__local_titles:
+          try:
+            title = await self.__title_batcher.generate(title_excerpt(conversation))
+          except Exception as e:
+            logging.warning(f"Could not generate title for conversation {conversation.id}, falling back to a local title: {e}")
 
-        title = await self.__request(messages)
+        title = title or heuristic_title(conversation)
         conversation.title = title
 
         logging.info(f"Set title for conversation {conversation}: '{title}'")
 
       asyncio.create_task(set_title(conversation))
 
-    logging.info(f"Completed message for chat {conversation.id}, message: '{assistant_message}'")
+    if self.__summarize_history:
+      self.__summarize_aged_messages(chat_id, conversation, system_message)
 
   def new_conversation(self, conversation_id: int, user_message: UserMessage) -> Conversation:
-    conversation = Conversation(conversation_id, None, user_message.timestamp, [user_message])
+    return Conversation(conversation_id, None, user_message.timestamp, [user_message])
+
+  def __build_context(self, conversation: Conversation, system_message: SystemMessage|None) -> list[Message]:
+    prefix_messages = [message for message in [system_message, conversation.summary] if message]
+    token_budget = self.__context_token_budget - sum(message.token_count for message in prefix_messages)
+
+    start = self.__recent_messages_start(conversation, token_budget)
+    if start > 0:
+      logging.info(f"Sending {len(conversation.messages) - start} of {len(conversation.messages)} messages for conversation {conversation.id}")
 
-    if self.__max_message_count and len(conversation.messages) > self.__max_message_count:
-      conversation.messages = conversation.messages[self.__max_message_count:]
+    return prefix_messages + conversation.messages[start:]
 
-    return conversation
+  def __recent_messages_start(self, conversation: Conversation, token_budget: int) -> int:
+    messages = conversation.messages
+    lower_bound = min(conversation.summarized_count, len(messages))
+    if self.__max_message_count:
+      lower_bound = max(lower_bound, len(messages) - self.__max_message_count)
 
-  async def __request(self, messages: list[Message]):
-    if self.__is_azure:
-      task = openai.ChatCompletion.acreate(
-        engine=self.__model_name,
-        messages=[{'role': message.role, 'content': message.content} for message in messages],
-      )
+    start = len(messages)
+    remaining_tokens = token_budget
+    while start > lower_bound:
+      remaining_tokens -= messages[start - 1].token_count
+      if remaining_tokens < 0 and start < len(messages):
+        break
+      start -= 1
+
+    return start
+
+  def __summarize_aged_messages(self, chat_id: int, conversation: Conversation, system_message: SystemMessage|None):
+    if id(conversation) in self.__summarizing_conversations:
+      return
+
+    prefix_messages = [message for message in [system_message, conversation.summary] if message]
+    token_budget = self.__context_token_budget - sum(message.token_count for message in prefix_messages)
+    if self.__recent_messages_start(conversation, token_budget) <= conversation.summarized_count:
+      return
+
+    # Leave half of the budget to recent messages so that a summary is only needed every few turns
+    end = self.__recent_messages_start(conversation, token_budget // 2)
+    if end <= conversation.summarized_count:
+      return
+
+    async def summarize(conversation: Conversation, start: int, end: int):
+      try:
+        prompt = f"You are a conversation summarizer. You will receive the summary of the earlier part of a conversation, if any, followed by later messages of it. You will reply with only an updated summary of the whole conversation in no more than {SUMMARY_WORD_LIMIT} words. Keep facts, names, numbers and decisions that may be referred to later."
+        transcript = '\n\n'.join(f"{message.role.value}: {message.content}" for message in conversation.messages[start:end])
+        if conversation.summary:
+          transcript = f"{conversation.summary.content}\n\n{transcript}"
+
+        summary = await self.__request([SystemMessage(prompt), UserMessage(-1, transcript)], chat_id, Priority.BACKGROUND)
+        conversation.summary = SystemMessage(f"Summary of the earlier part of this conversation: {summary}")
+        conversation.summarized_count = end
+
+        logging.info(f"Summarized {end - start} messages for conversation {conversation.id}: '{summary}'")
+      except Exception as e:
+        logging.warning(f"Could not summarize conversation {conversation.id}: {e}")
+      finally:
+        self.__summarizing_conversations.discard(id(conversation))
+
+    self.__summarizing_conversations.add(id(conversation))
+    asyncio.create_task(summarize(conversation, conversation.summarized_count, end))
+
+  @property
+  def __client_session(self) -> ClientSession:
+    # Created on first use so that it's bound to the running event loop
+    if not self.__session or self.__session.closed:
+      connector = TCPConnector(limit=self.__max_connections, ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=self.__keepalive_timeout)
+      self.__session = ClientSession(connector=connector, trust_env=True)
+    return self.__session
+
+  def __endpoint(self, backend: Backend, messages: list[Message], stream: bool, model_name: str|None = None) -> tuple[str, dict[str, str], dict]:
+    options = backend.options
+    model_name = model_name or options.model_name
+    payload = {'messages': [{'role': message.role, 'content': message.content} for message in messages], 'stream': stream}
+    if options.azure_endpoint:
+      url = f"{options.azure_endpoint.rstrip('/')}/openai/deployments/{model_name}/chat/completions?api-version={AZURE_API_VERSION}"
+      headers = {'api-key': options.api_key}
     else:
-      task = openai.ChatCompletion.acreate(
-        model=self.__model_name,
-        messages=[{'role': message.role, 'content': message.content} for message in messages],
-      )
-    response = await asyncio.wait_for(task, 60)
-    return cast(dict, response)['choices'][0]['message']['content']
-
-  async def __stream(self, messages: list[Message]):
-    if self.__is_azure:
-      task = openai.ChatCompletion.acreate(
-        engine=self.__model_name,
-        messages=[{'role': message.role, 'content': message.content} for message in messages],
-        stream=True,
-      )
+      url = f"{OPENAI_API_BASE}/chat/completions"
+      headers = {'Authorization': f"Bearer {options.api_key}"}
+      payload['model'] = model_name
+    return url, headers, payload
+
+  async def __raise_for_status(self, response: ClientResponse):
+    if response.status == 200:
+      return
+
+    body = await response.text()
+    error_type = openai.error.RateLimitError if response.status == 429 else openai.error.APIError
+    raise error_type(f"Chat completion request failed with status {response.status}: {body}", http_body=body, http_status=response.status, headers=dict(response.headers))
+
+  def __handle_backend_error(self, backend: Backend, error: Exception) -> bool:
+    if isinstance(error, openai.error.OpenAIError):
+      if error.http_status != 429 and (error.http_status or 0) < 500:
+        return False
+      retry_after = error.headers.get('Retry-After')
+      backend.record_failure(float(retry_after) if retry_after and retry_after.isdigit() else None)
+    elif isinstance(error, (ClientError, TimeoutError)):
+      backend.record_failure()
     else:
-      task = openai.ChatCompletion.acreate(
-        model=self.__model_name,
-        messages=[{'role': message.role, 'content': message.content} for message in messages],
-        stream=True,
-      )
-    async for response in await task:
-      content = cast(dict, response)['choices'][0]['delta'].get('content')
-      if content:
-        yield content
+      return False
+
+    logging.warning(f"Backend {backend} failed, trying another backend: {error}")
+    return True
+
+  async def __request(self, messages: list[Message], key: Hashable, priority: Priority, *, model_name: str|None = None):
+    await self.__scheduler.acquire(key, priority, sum(message.token_count for message in messages))
+
+    tried_backends = []
+    while lease := self.__backends.acquire(tried_backends):
+      backend = lease.backend
+      tried_backends.append(backend)
+      url, headers, payload = self.__endpoint(backend, messages, stream=False, model_name=model_name)
+      start_time = asyncio.get_running_loop().time()
+      try:
+        async with self.__client_session.post(url, json=payload, headers=headers, timeout=ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=CONNECT_TIMEOUT)) as response:
+          await self.__raise_for_status(response)
+          content = (await response.json())['choices'][0]['message']['content']
+
+        backend.record_success(asyncio.get_running_loop().time() - start_time)
+        self.__scheduler.record_usage(estimate_token_count(content))
+        return content
+      except Exception as e:
+        if not self.__handle_backend_error(backend, e) or len(tried_backends) == len(self.__backends.backends):
+          raise
+      finally:
+        lease.release()
+
+  async def __replay(self, content: str):
+    yield content
+
+  async def __stream(self, messages: list[Message], chat_id: int, priority: Priority, answering_backends: list[Backend]|None = None):
+    prompt_token_count = sum(message.token_count for message in messages)
+    await self.__scheduler.acquire(chat_id, priority, prompt_token_count)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FIRST_TOKEN_TIMEOUT
+    tried_backends: list[Backend] = []
+    attempts: dict[asyncio.Future, tuple[BackendLease, AsyncGenerator[str, None]]] = {}
+    winner: tuple[BackendLease, AsyncGenerator[str, None]]|None = None
+    is_hedged = False
+    completion_token_count = 0
+
+    async def close_attempts(futures: list[asyncio.Future], streams: list[tuple[BackendLease, AsyncGenerator[str, None]]]):
+      # Abandoning a stream closes its connection, which stops the generation on that backend
+      for future in futures:
+        future.cancel()
+      await asyncio.gather(*futures, return_exceptions=True)
+      for lease, chunks in streams:
+        await chunks.aclose()
+        lease.release()
+
+    def start_attempt(lease: BackendLease|None):
+      if not lease:
+        return False
+      tried_backends.append(lease.backend)
+      chunks = self.__stream_backend(lease.backend, messages)
+      attempts[asyncio.ensure_future(anext(chunks))] = (lease, chunks)
+      return True
+
+    try:
+      start_attempt(self.__backends.acquire(tried_backends))
+
+      # Race the attempts for the first token, since the response can't be switched to another backend after that
+      while not winner:
+        timeout = deadline - loop.time()
+        if not is_hedged:
+          timeout = min(timeout, FIRST_TOKEN_HEDGE_DELAY)
+
+        done, _ = await asyncio.wait(attempts, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+          if loop.time() >= deadline:
+            # A backend that doesn't respond at all counts as failing, so that its circuit breaker opens
+            for lease, _ in attempts.values():
+              lease.backend.record_failure()
+            raise TimeoutError(f"No response within {FIRST_TOKEN_TIMEOUT} seconds")
+
+          # A hedge is a request of its own, so it's only sent when the rate limits allow it right away
+          is_hedged = True
+          if not self.__scheduler.try_acquire(prompt_token_count):
+            logging.warning(f"First token of chat {chat_id} is late, but not hedging because of rate limits")
+            continue
+
+          # Prefer a backend that hasn't been tried, but duplicate the request on the same one when there's no other
+          if start_attempt(self.__backends.acquire(tried_backends) or self.__backends.acquire([])):
+            logging.warning(f"First token of chat {chat_id} is late, hedging with backend {tried_backends[-1]}")
+          continue
+
+        for future in done:
+          lease, chunks = attempts.pop(future)
+          try:
+            first_chunk = future.result()
+          except StopAsyncIteration:
+            first_chunk = None
+          except Exception as e:
+            lease.release()
+            if not self.__handle_backend_error(lease.backend, e):
+              raise
+            if not attempts and not start_attempt(self.__backends.acquire(tried_backends)):
+              raise
+            continue
+
+          winner = (lease, chunks)
+          break
+
+      if attempts:
+        logging.info(f"Cancelling {len(attempts)} slower attempts of chat {chat_id}")
+        losers = dict(attempts)
+        attempts.clear()
+        await close_attempts(list(losers), list(losers.values()))
+
+      lease, chunks = winner
+      if answering_backends is not None:
+        answering_backends.append(lease.backend)
+      if first_chunk is None:
+        return
+
+      completion_token_count += estimate_token_count(first_chunk)
+      yield first_chunk
+      async for chunk in chunks:
+        completion_token_count += estimate_token_count(chunk)
+        yield chunk
+    finally:
+      await close_attempts(list(attempts), list(attempts.values()) + ([winner] if winner else []))
+
+      # Generated tokens count towards the budget as well, including those of a stopped generation
+      self.__scheduler.record_usage(completion_token_count)
+
+  async def __stream_backend(self, backend: Backend, messages: list[Message]) -> AsyncGenerator[str, None]:
+    url, headers, payload = self.__endpoint(backend, messages, stream=True)
+    start_time = asyncio.get_running_loop().time()
+    has_received_content = False
+
+    async with self.__client_session.post(url, json=payload, headers=headers, timeout=ClientTimeout(sock_connect=CONNECT_TIMEOUT)) as response:
+      await self.__raise_for_status(response)
+
+      # The wait for the first token is bounded by the caller, which can hedge it with another attempt
+      while line := await asyncio.wait_for(response.content.readline(), TOKEN_TIMEOUT if has_received_content else None):
+        if not line.startswith(b'data:'):
+          continue
+
+        data = line[len(b'data:'):].strip()
+        if data == b'[DONE]':
+          break
+
+        choices = json.loads(data)['choices']
+        content = choices[0]['delta'].get('content') if choices else None
+        if content:
+          if not has_received_content:
+            has_received_content = True
+            backend.record_success(asyncio.get_running_loop().time() - start_time)
+          yield content
@@ -0,0 +1,115 @@
+import bisect
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Sequence
+from models import Conversation, Message
+
+HISTORY_PAGE_SIZE = 20
+
+def search_terms(text: str) -> set[str]:
+  return set(re.findall(r'\w+', text.lower()))
+
+class ConversationIndex:
+  def __init__(self, conversations: list[Conversation]):
+    self.__entries: list[tuple[datetime, int]] = sorted((conversation.started_at, conversation.id) for conversation in conversations)
+
+  @property
+  def page_count(self) -> int:
+    return max((len(self.__entries) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE, 1)
+
+  def add(self, conversation: Conversation):
+    entry = (conversation.started_at, conversation.id)
+    index = bisect.bisect_left(self.__entries, entry)
+    if index == len(self.__entries) or self.__entries[index] != entry:
+      self.__entries.insert(index, entry)
+
+  def page(self, page: int) -> list[int]:
+    # Pages start from the latest conversation
+    end = len(self.__entries) - page * HISTORY_PAGE_SIZE
+    return [conversation_id for _, conversation_id in reversed(self.__entries[max(end - HISTORY_PAGE_SIZE, 0):max(end, 0)])]
+
+REINDEXABLE_MESSAGE_COUNT = 2
+
+@dataclass
+class _IndexedConversation:
+  message_ids: list[int] = field(default_factory=list)
+  term_counts: Counter[str] = field(default_factory=Counter)
+  # Terms of the last messages are kept, so that they can be removed when the messages are retried
+  tail_terms: list[set[str]] = field(default_factory=list)
+  title: str|None = None
+  title_terms: set[str] = field(default_factory=set)
+
+class SearchIndex:
+  def __init__(self):
+    self.__postings: dict[str, set[int]] = {}
+    self.__conversations: dict[int, _IndexedConversation] = {}
+
+  def update(self, conversation: Conversation, messages: Sequence[Message]|None = None):
+    indexed = self.__conversations.setdefault(conversation.id, _IndexedConversation())
+
+    if messages is not None:
+      # Messages are only appended or removed from the end, so the indexed ones are compared from the end
+      kept_count = min(len(indexed.message_ids), len(messages))
+      while kept_count > 0 and indexed.message_ids[kept_count - 1] != messages[kept_count - 1].id:
+        kept_count -= 1
+
+      removed_count = len(indexed.message_ids) - kept_count
+      if removed_count > len(indexed.tail_terms):
+        self.__remove(conversation.id)
+        indexed = self.__conversations.setdefault(conversation.id, _IndexedConversation())
+        kept_count = 0
+      else:
+        for _ in range(removed_count):
+          indexed.message_ids.pop()
+          self.__remove_terms(conversation.id, indexed, indexed.tail_terms.pop())
+
+      for message in messages[kept_count:]:
+        terms = search_terms(message.content)
+        self.__add_terms(conversation.id, indexed, terms)
+        indexed.message_ids.append(message.id)
+        indexed.tail_terms.append(terms)
+      del indexed.tail_terms[:-REINDEXABLE_MESSAGE_COUNT]
+
+    if conversation.title != indexed.title:
+      self.__remove_terms(conversation.id, indexed, indexed.title_terms)
+      indexed.title = conversation.title
+      indexed.title_terms = search_terms(conversation.title) if conversation.title else set()
+      self.__add_terms(conversation.id, indexed, indexed.title_terms)
+
+  def __add_terms(self, conversation_id: int, indexed: _IndexedConversation, terms: set[str]):
+    for term in terms:
+      indexed.term_counts[term] += 1
+      if indexed.term_counts[term] == 1:
+        self.__postings.setdefault(term, set()).add(conversation_id)
+
+  def __remove_terms(self, conversation_id: int, indexed: _IndexedConversation, terms: set[str]):
+    for term in terms:
+      indexed.term_counts[term] -= 1
+      if indexed.term_counts[term] <= 0:
+        del indexed.term_counts[term]
+        self.__discard_posting(term, conversation_id)
+
+  def __remove(self, conversation_id: int):
+    indexed = self.__conversations.pop(conversation_id)
+    for term in indexed.term_counts:
+      self.__discard_posting(term, conversation_id)
+
+  def __discard_posting(self, term: str, conversation_id: int):
+    conversation_ids = self.__postings.get(term)
+    if conversation_ids is not None:
+      conversation_ids.discard(conversation_id)
+      if not conversation_ids:
+        del self.__postings[term]
+
+  def search(self, query: str) -> set[int]:
+    terms = sorted(search_terms(query), key=lambda term: len(self.__postings.get(term, ())))
+    if not terms:
+      return set()
+
+    # Intersecting from the rarest term keeps the intermediate results small
+    conversation_ids = set(self.__postings.get(terms[0], ()))
+    for term in terms[1:]:
+      conversation_ids &= self.__postings.get(term, set())
+    return conversation_ids
@@ -1,48 +1,286 @@
+import bisect
+import time
+from array import array
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
+from typing import Iterable, Sequence, cast, overload
+
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_token_count(text: str) -> int:
+  ascii_count = sum(1 for char in text if char.isascii())
+  return (ascii_count + 3) // 4 + len(text) - ascii_count
 
 class Role(str, Enum):
   SYSTEM = 'system'
   ASSISTANT = 'assistant'
   USER = 'user'
 
-@dataclass
+def _epoch(timestamp: datetime|int|None) -> int:
+  if timestamp is None:
+    return int(time.time())
+  if isinstance(timestamp, datetime):
+    return int(timestamp.timestamp())
+  return timestamp
+
+# Messages are stored in large numbers, so they have no instance dictionary and are pickled as tuples.
+# Messages pickled as dictionaries by earlier versions are still loaded.
 class Message:
-  id: int
-  role: Role
-  content: str
-  timestamp: datetime
+  __slots__ = ('id', 'role', 'content', 'created_at', '_token_count_cache')
+
+  def __init__(self, id: int, role: Role, content: str, timestamp: datetime|int|None = None):
+    self.id = id
+    self.role = role
+    self.content = content
+    self.created_at = _epoch(timestamp)
+    self._token_count_cache: tuple[str, int]|None = None
+
+  @property
+  def timestamp(self) -> datetime:
+    return datetime.fromtimestamp(self.created_at)
+
+  @property
+  def token_count(self) -> int:
+    cache = self._token_count_cache
+    if cache is None or cache[0] is not self.content:
+      cache = (self.content, estimate_token_count(self.content) + MESSAGE_TOKEN_OVERHEAD)
+      self._token_count_cache = cache
+    return cache[1]
+
+  def __repr__(self) -> str:
+    return f"{type(self).__name__}(id={self.id!r}, role={self.role!r}, content={self.content!r}, timestamp={self.timestamp!r})"
+
+  def __eq__(self, other: object) -> bool:
+    return type(self) is type(other) and self.__getstate__() == cast(Message, other).__getstate__()
+
+  __hash__ = None  # type: ignore
+
+  def __getstate__(self) -> tuple:
+    return (self.id, self.role.value, self.content, self.created_at)
+
+  def __setstate__(self, state: tuple|dict):
+    if isinstance(state, dict):
+      state = (state['id'], state['role'], state['content'], state['timestamp'])
+    id, role, content, timestamp = state[:4]
+    self.id = id
+    self.role = Role(role)
+    self.content = content
+    self.created_at = _epoch(timestamp)
+    self._token_count_cache = None
 
 class SystemMessage(Message):
-  def __init__(self, content: str, timestamp: datetime|None = None):
-    super().__init__(-1, Role.SYSTEM, content, timestamp or datetime.now())
+  __slots__ = ()
+
+  def __init__(self, content: str, timestamp: datetime|int|None = None):
+    super().__init__(-1, Role.SYSTEM, content, timestamp)
 
 class AssistantMessage(Message):
-  replied_to_id: int
+  __slots__ = ('replied_to_id', 'continuation_ids')
 
-  def __init__(self, id: int, content: str, replied_to_id: int, timestamp: datetime|None = None):
-    super().__init__(id, Role.ASSISTANT, content, timestamp or datetime.now())
-    self.id = id
+  def __init__(self, id: int, content: str, replied_to_id: int, timestamp: datetime|int|None = None):
+    super().__init__(id, Role.ASSISTANT, content, timestamp)
     self.replied_to_id = replied_to_id
+    self.continuation_ids: list[int] = []
+
+  @property
+  def message_ids(self) -> list[int]:
+    return [self.id] + self.continuation_ids
+
+  def __getstate__(self) -> tuple:
+    return super().__getstate__() + (self.replied_to_id, self.continuation_ids)
+
+  def __setstate__(self, state: tuple|dict):
+    super().__setstate__(state)
+    if isinstance(state, dict):
+      self.replied_to_id = state.get('replied_to_id', -1)
+      self.continuation_ids = state.get('continuation_ids', [])
+    else:
+      self.replied_to_id, self.continuation_ids = state[4:]
 
 class UserMessage(Message):
-  answer_id: int|None
+  __slots__ = ('answer_id',)
 
-  def __init__(self, id: int, content: str, timestamp: datetime|None = None):
-    super().__init__(id, Role.USER, content, timestamp or datetime.now())
-    self.id = id
-    self.answer_id = None
+  def __init__(self, id: int, content: str, timestamp: datetime|int|None = None):
+    super().__init__(id, Role.USER, content, timestamp)
+    self.answer_id: int|None = None
+
+  def __getstate__(self) -> tuple:
+    return super().__getstate__() + (self.answer_id,)
+
+  def __setstate__(self, state: tuple|dict):
+    super().__setstate__(state)
+    self.answer_id = state.get('answer_id') if isinstance(state, dict) else state[4]
+
+_ROLES = list(Role)
+_NO_LINK = -2 ** 63
+
+class MessageArchive(Sequence[Message]):
+  # Messages of conversations that are no longer continued are kept in columns, and are only created when read
+  def __init__(self, messages: Iterable[Message]):
+    self.__ids = array('q')
+    self.__created_ats = array('q')
+    self.__links = array('q')
+    self.__roles = bytearray()
+    self.__contents: list[str] = []
+    self.__continuation_ids: dict[int, list[int]] = {}
+
+    for message in messages:
+      if isinstance(message, AssistantMessage):
+        link = message.replied_to_id
+        if message.continuation_ids:
+          self.__continuation_ids[len(self.__ids)] = list(message.continuation_ids)
+      elif isinstance(message, UserMessage):
+        link = message.answer_id
+      else:
+        link = None
+
+      self.__ids.append(message.id)
+      self.__created_ats.append(message.created_at)
+      self.__links.append(_NO_LINK if link is None else link)
+      self.__roles.append(_ROLES.index(message.role))
+      self.__contents.append(message.content)
+
+  def __len__(self) -> int:
+    return len(self.__ids)
+
+  @overload
+  def __getitem__(self, index: int) -> Message: ...
+
+  @overload
+  def __getitem__(self, index: slice) -> list[Message]: ...
+
+  def __getitem__(self, index: int|slice) -> Message|list[Message]:
+    if isinstance(index, slice):
+      return [self.__message(position) for position in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('message index out of range')
+    return self.__message(index)
+
+  def find(self, message_id: int) -> Message|None:
+    # Messages are sent one after another, so their ids are in order, but any order is still searched
+    position = bisect.bisect_left(self.__ids, message_id)
+    if position < len(self.__ids) and self.__ids[position] == message_id:
+      return self.__message(position)
+
+    for position, continuation_ids in self.__continuation_ids.items():
+      if message_id in continuation_ids:
+        return self.__message(position)
+
+    try:
+      return self.__message(self.__ids.index(message_id))
+    except ValueError:
+      return None
+
+  def message_ids(self) -> list[int]:
+    return list(self.__ids) + [message_id for continuation_ids in self.__continuation_ids.values() for message_id in continuation_ids]
+
+  def __message(self, position: int) -> Message:
+    id, content, created_at, link = self.__ids[position], self.__contents[position], self.__created_ats[position], self.__links[position]
+    role = _ROLES[self.__roles[position]]
+
+    message: Message
+    if role == Role.ASSISTANT:
+      message = AssistantMessage(id, content, link, created_at)
+      message.continuation_ids = list(self.__continuation_ids.get(position, []))
+    elif role == Role.USER:
+      message = UserMessage(id, content, created_at)
+      message.answer_id = None if link == _NO_LINK else link
+    else:
+      message = Message(id, role, content, created_at)
+    return message
 
 @dataclass
 class Conversation:
   id: int
   title: str|None
   started_at: datetime
-  messages: list[Message]
+  messages: list[Message]|MessageArchive
+  summary: SystemMessage|None = None
+  summarized_count: int = 0
 
   @property
   def last_message(self):
     if len(self.messages) == 0:
       return None
     return self.messages[-1]
+
+  def append_message(self, message: Message):
+    messages = self.__thaw()
+    messages.append(message)
+    self.__index_message(message)
+
+  def pop_message(self) -> Message:
+    message = self.__thaw().pop()
+    index = getattr(self, '_message_index', None)
+    if index and index[0] is self.messages and index[1] == len(self.messages) + 1:
+      for message_id in get_message_ids(message):
+        index[2].pop(message_id, None)
+      self._message_index = (self.messages, len(self.messages), index[2])
+    return message
+
+  def message_ids(self) -> list[int]:
+    if isinstance(self.messages, MessageArchive):
+      return self.messages.message_ids()
+    return [message_id for message in self.messages for message_id in get_message_ids(message)]
+
+  def find_message(self, message_id: int) -> Message|None:
+    # Archived messages are looked up by their ids, without creating the other messages
+    if isinstance(self.messages, MessageArchive):
+      return self.messages.find(message_id)
+
+    index = getattr(self, '_message_index', None)
+    # The index is rebuilt when the list has been replaced or shrunk without pop_message, and catches up with appended messages
+    if not index or index[0] is not self.messages or index[1] > len(self.messages):
+      index = (self.messages, 0, {})
+    messages, indexed_count, message_index = index
+    for message in messages[indexed_count:]:
+      for id in get_message_ids(message):
+        message_index[id] = message
+    self._message_index = (messages, len(messages), message_index)
+
+    # Pages of the last message are sent while it's being generated
+    if self.messages:
+      for id in get_message_ids(self.messages[-1]):
+        message_index[id] = self.messages[-1]
+
+    return message_index.get(message_id)
+
+  def archive(self):
+    if isinstance(self.messages, list):
+      self.messages = MessageArchive(self.messages)
+
+  def __thaw(self) -> list[Message]:
+    # An archived conversation is turned back into a list when it's continued
+    if not isinstance(self.messages, list):
+      self.messages = list(self.messages)
+    return self.messages
+
+  def __index_message(self, message: Message):
+    index = getattr(self, '_message_index', None)
+    if index and index[0] is self.messages and index[1] == len(self.messages) - 1:
+      for message_id in get_message_ids(message):
+        index[2][message_id] = message
+      self._message_index = (self.messages, len(self.messages), index[2])
+
+  @property
+  def header_version(self) -> int:
+    return self.__dict__.get('_header_version', 0)
+
+  def __setattr__(self, name: str, value):
+    super().__setattr__(name, value)
+    # Changes of anything but the messages are counted, so that the header is only written again when it has changed
+    if name != 'messages' and not name.startswith('_'):
+      self.__dict__['_header_version'] = self.header_version + 1
+
+  def __getstate__(self):
+    # The index is rebuilt on demand instead of being persisted.
+    # The version is kept, so that the copies of the chat data given to the persistence can be compared with what was written.
+    state = dict(self.__dict__)
+    state.pop('_message_index', None)
+    return state
+
+def get_message_ids(message: Message) -> list[int]:
+  return message.message_ids if isinstance(message, AssistantMessage) else [message.id]
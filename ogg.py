@@ -0,0 +1,100 @@
+import struct
+from dataclasses import dataclass
+
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+_BEGINNING_OF_STREAM = 0x02
+_END_OF_STREAM = 0x04
+_OPUS_HEADER_PACKET_COUNT = 2
+
+def _crc_table() -> list[int]:
+  table = []
+  for index in range(256):
+    crc = index << 24
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+    table.append(crc & 0xFFFFFFFF)
+  return table
+
+_CRC_TABLE = _crc_table()
+
+def _crc(data: bytes) -> int:
+  crc = 0
+  for byte in data:
+    crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+  return crc
+
+@dataclass
+class _Page:
+  header_type: int
+  granule_position: int
+  serial_number: int
+  sequence_number: int
+  segments: bytes
+  body: bytes
+
+  @property
+  def completed_packet_count(self) -> int:
+    return sum(1 for lacing_value in self.segments if lacing_value < 255)
+
+  def encode(self) -> bytes:
+    header = _PAGE_HEADER.pack(b'OggS', 0, self.header_type, self.granule_position, self.serial_number, self.sequence_number, 0, len(self.segments))
+    page = header + self.segments + self.body
+    return page[:22] + struct.pack('<I', _crc(page)) + page[26:]
+
+def _read_pages(data: bytes) -> list[_Page]:
+  pages = []
+  offset = 0
+  while offset < len(data):
+    capture_pattern, _, header_type, granule_position, serial_number, sequence_number, _, segment_count = _PAGE_HEADER.unpack_from(data, offset)
+    if capture_pattern != b'OggS':
+      raise ValueError(f"Invalid Ogg page at offset {offset}")
+
+    offset += _PAGE_HEADER.size
+    segments = data[offset:offset + segment_count]
+    offset += segment_count
+    body = data[offset:offset + sum(segments)]
+    offset += sum(segments)
+
+    pages.append(_Page(header_type, granule_position, serial_number, sequence_number, segments, body))
+  return pages
+
+def join_opus(streams: list[bytes]) -> bytes:
+  if len(streams) == 1:
+    return streams[0]
+
+  # Streams are appended to the first one as a single logical stream, since chained streams are not played by all clients.
+  # Only the pre-skip of the first stream is applied, so the priming samples of the later ones are played where they are joined.
+  # They are the encoder's lookahead of a few milliseconds, which can't be trimmed without cutting into a packet and re-encoding it,
+  # and since each stream starts at a sentence, in the leading silence of the synthesized speech, they play as a short pause rather than a click.
+  output = []
+  serial_number = None
+  sequence_number = 0
+  granule_offset = 0
+
+  for index, stream in enumerate(streams):
+    pages = _read_pages(stream)
+    skipped_packet_count = 0
+    last_granule_position = 0
+
+    for page in pages:
+      if index > 0 and skipped_packet_count < _OPUS_HEADER_PACKET_COUNT:
+        skipped_packet_count += page.completed_packet_count
+        continue
+
+      if serial_number is None:
+        serial_number = page.serial_number
+      if page.granule_position != -1:
+        last_granule_position = page.granule_position
+
+      is_last_page = index == len(streams) - 1 and page is pages[-1]
+      header_type = page.header_type & ~_END_OF_STREAM | (_END_OF_STREAM if is_last_page else 0)
+      if index > 0:
+        header_type &= ~_BEGINNING_OF_STREAM
+      granule_position = page.granule_position + granule_offset if page.granule_position != -1 else -1
+
+      output.append(_Page(header_type, granule_position, serial_number, sequence_number, page.segments, page.body).encode())
+      sequence_number += 1
+
+    granule_offset += last_granule_position
+
+  return b''.join(output)
@@ -0,0 +1,436 @@
+import fcntl
+import logging
+import os
+import pickle
+import sqlite3
+from chat import ChatData
+from contextlib import contextmanager
+from copy import copy
+from dataclasses import dataclass, field
+from models import Conversation, Message, MessageArchive, get_message_ids
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+from typing import Any, Callable, cast
+
+COMPACTION_MIN_RECORD_COUNT = 256
+
+def _fingerprint(message: Message) -> tuple:
+  return (message.id, message.role, len(message.content), hash(message.content))
+
+def _pickle_settings(data: ChatData) -> bytes:
+  return pickle.dumps({key: value for key, value in data.items() if key != 'conversations'}, pickle.HIGHEST_PROTOCOL)
+
+def _pickle_header(conversation: Conversation) -> bytes:
+  header = copy(conversation)
+  header.messages = []
+  # The version only matters in memory, so equal headers are pickled to equal bytes
+  header.__dict__.pop('_header_version', None)
+  return pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+
+@dataclass
+class _WrittenChatData:
+  settings: bytes|None = None
+  headers: dict[int, bytes] = field(default_factory=dict)
+  fingerprints: dict[int, list[tuple]] = field(default_factory=dict)
+  header_versions: dict[int, int] = field(default_factory=dict)
+
+  def track(self, data: ChatData):
+    self.settings = _pickle_settings(data)
+    for conversation in data.get('conversations', {}).values():
+      self.headers[conversation.id] = _pickle_header(conversation)
+      self.header_versions[conversation.id] = conversation.header_version
+      self.fingerprints[conversation.id] = [_fingerprint(message) for message in conversation.messages]
+
+@dataclass
+class _ChatDataChanges:
+  settings: bytes|None = None
+  headers: dict[int, bytes] = field(default_factory=dict)
+  messages: dict[int, tuple[int, list[Message]]] = field(default_factory=dict)
+
+def _diff_chat_data(written: _WrittenChatData, data: ChatData) -> _ChatDataChanges:
+  changes = _ChatDataChanges()
+
+  settings = _pickle_settings(data)
+  if settings != written.settings:
+    changes.settings = settings
+    written.settings = settings
+
+  for conversation in data.get('conversations', {}).values():
+    # Conversations whose messages haven't been loaded have a header but no fingerprints
+    fingerprints = written.fingerprints.get(conversation.id)
+    if fingerprints is None and conversation.id not in written.headers:
+      fingerprints = []
+      written.fingerprints[conversation.id] = fingerprints
+
+    # Headers are only pickled again for conversations that have changed since they were written
+    if written.header_versions.get(conversation.id) != conversation.header_version:
+      header = _pickle_header(conversation)
+      if header != written.headers.get(conversation.id):
+        changes.headers[conversation.id] = header
+        written.headers[conversation.id] = header
+      written.header_versions[conversation.id] = conversation.header_version
+
+    if fingerprints is None or not conversation.messages:
+      continue
+    # Archived messages are only created from written ones and can't change
+    if isinstance(conversation.messages, MessageArchive) and len(fingerprints) == len(conversation.messages):
+      continue
+
+    start = min(len(fingerprints), len(conversation.messages))
+    while start > 0 and fingerprints[start - 1] != _fingerprint(conversation.messages[start - 1]):
+      start -= 1
+
+    if start < len(fingerprints) or start < len(conversation.messages):
+      messages = conversation.messages[start:]
+      changes.messages[conversation.id] = (start, messages)
+      fingerprints[start:] = [_fingerprint(message) for message in messages]
+
+  return changes
+
+async def _load_legacy_chat_data(filepath: str|None) -> dict[int, ChatData]:
+  if not filepath or not os.path.exists(filepath):
+    return {}
+  return cast(dict[int, ChatData], await PicklePersistence(filepath).get_chat_data())
+
+@dataclass
+class _ChatLog(_WrittenChatData):
+  record_count: int = 0
+  size: int = 0
+  snapshot_size: int = 0
+
+@contextmanager
+def _startup_lock(path: str):
+  # Worker processes load a store one at a time, so that legacy data is only migrated by the first one
+  with open(path, 'a') as file:
+    fcntl.flock(file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(file, fcntl.LOCK_UN)
+
+# Base of chat data stores. A store can be shared by worker processes as long as each chat is only written by the worker that owns it.
+class ChatDataPersistence(BasePersistence[dict, ChatData, dict]):
+  def __init__(self, update_interval: float, owns_chat: Callable[[int], bool]|None = None):
+    super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=False, callback_data=False), update_interval=update_interval)
+    self.owns_chat = owns_chat or (lambda _: True)
+
+  async def get_user_data(self) -> dict[int, dict]:
+    return {}
+
+  async def get_bot_data(self) -> dict:
+    return {}
+
+  async def get_callback_data(self) -> None:
+    return None
+
+  async def get_conversations(self, name: str) -> dict:
+    return {}
+
+  async def update_user_data(self, user_id: int, data: dict):
+    pass
+
+  async def update_bot_data(self, data: dict):
+    pass
+
+  async def update_callback_data(self, data: Any):
+    pass
+
+  async def update_conversation(self, name: str, key: tuple[int|str, ...], new_state: object|None):
+    pass
+
+  async def drop_user_data(self, user_id: int):
+    pass
+
+  async def refresh_user_data(self, user_id: int, user_data: dict):
+    pass
+
+  async def refresh_bot_data(self, bot_data: dict):
+    pass
+
+class ChatLogPersistence(ChatDataPersistence):
+  def __init__(self, directory: str, *, legacy_filepath: str|None = None, update_interval: float = 10, owns_chat: Callable[[int], bool]|None = None):
+    super().__init__(update_interval, owns_chat)
+    self.__directory = directory
+    self.__legacy_filepath = legacy_filepath
+    self.__chat_logs: dict[int, _ChatLog] = {}
+
+  async def get_chat_data(self) -> dict[int, ChatData]:
+    with _startup_lock(self.__directory + '.lock'):
+      all_chat_data = await self.__load_chat_data()
+    return {chat_id: chat_data for chat_id, chat_data in all_chat_data.items() if self.owns_chat(chat_id)}
+
+  async def __load_chat_data(self) -> dict[int, ChatData]:
+    if not os.path.isdir(self.__directory):
+      os.makedirs(self.__directory)
+      return await self.__migrate_legacy_data()
+
+    all_chat_data = {}
+    for filename in os.listdir(self.__directory):
+      name, extension = os.path.splitext(filename)
+      if extension != '.log':
+        continue
+
+      chat_id = int(name)
+      if not self.owns_chat(chat_id):
+        continue
+
+      chat_data, chat_log = self.__replay(chat_id)
+      all_chat_data[chat_id] = chat_data
+      self.__chat_logs[chat_id] = chat_log
+
+    logging.info(f"Loaded data of {len(all_chat_data)} chats from {self.__directory}")
+
+    return all_chat_data
+
+  async def update_chat_data(self, chat_id: int, data: ChatData):
+    chat_log = self.__chat_logs.get(chat_id)
+    if not chat_log:
+      chat_log = _ChatLog()
+      self.__chat_logs[chat_id] = chat_log
+
+    changes = _diff_chat_data(chat_log, data)
+
+    records = []
+    if changes.settings is not None:
+      records.append(('settings', changes.settings))
+    for header in changes.headers.values():
+      records.append(('conversation', header))
+    for conversation_id, (start, messages) in changes.messages.items():
+      records.append(('messages', pickle.dumps((conversation_id, start, messages), pickle.HIGHEST_PROTOCOL)))
+
+    if not records:
+      return
+
+    if chat_log.record_count + len(records) > COMPACTION_MIN_RECORD_COUNT and chat_log.size > 2 * chat_log.snapshot_size:
+      self.__compact(chat_id, data, chat_log)
+    else:
+      self.__append(chat_id, records, chat_log)
+
+  async def drop_chat_data(self, chat_id: int):
+    self.__chat_logs.pop(chat_id, None)
+    path = self.__log_path(chat_id)
+    if os.path.exists(path):
+      os.remove(path)
+
+  async def refresh_chat_data(self, chat_id: int, chat_data: ChatData):
+    pass
+
+  async def flush(self):
+    logging.info(f"Flushed data of {len(self.__chat_logs)} chats to {self.__directory}")
+
+  def __log_path(self, chat_id: int) -> str:
+    return os.path.join(self.__directory, f"{chat_id}.log")
+
+  def __append(self, chat_id: int, records: list[tuple[str, bytes]], chat_log: _ChatLog):
+    with open(self.__log_path(chat_id), 'ab') as file:
+      for record in records:
+        pickle.dump(record, file, pickle.HIGHEST_PROTOCOL)
+      file.flush()
+      os.fsync(file.fileno())
+      chat_log.size = file.tell()
+
+    chat_log.record_count += len(records)
+
+  def __compact(self, chat_id: int, data: ChatData, chat_log: _ChatLog):
+    path = self.__log_path(chat_id)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+      pickle.dump(('snapshot', pickle.dumps(data, pickle.HIGHEST_PROTOCOL)), file, pickle.HIGHEST_PROTOCOL)
+      file.flush()
+      os.fsync(file.fileno())
+      size = file.tell()
+    os.replace(temp_path, path)
+
+    logging.info(f"Compacted data of chat {chat_id} from {chat_log.record_count} records and {chat_log.size} bytes to {size} bytes")
+
+    chat_log.record_count = 1
+    chat_log.size = size
+    chat_log.snapshot_size = size
+
+  def __replay(self, chat_id: int) -> tuple[ChatData, _ChatLog]:
+    path = self.__log_path(chat_id)
+    data: dict = {'conversations': {}}
+    chat_log = _ChatLog()
+
+    with open(path, 'rb') as file:
+      while True:
+        offset = file.tell()
+        try:
+          kind, payload = pickle.load(file)
+        except EOFError:
+          break
+        except Exception as e:
+          logging.warning(f"Discarding incomplete records at offset {offset} of {path}: {e}")
+          file.close()
+          os.truncate(path, offset)
+          break
+
+        conversations: dict[int, Conversation] = data['conversations']
+        if kind == 'snapshot':
+          data = pickle.loads(payload)
+          data.setdefault('conversations', {})
+          chat_log.snapshot_size = file.tell()
+        elif kind == 'settings':
+          data = {**pickle.loads(payload), 'conversations': conversations}
+        elif kind == 'conversation':
+          header = cast(Conversation, pickle.loads(payload))
+          existing_conversation = conversations.get(header.id)
+          header.messages = existing_conversation.messages if existing_conversation else []
+          conversations[header.id] = header
+        elif kind == 'messages':
+          conversation_id, start, messages = pickle.loads(payload)
+          conversation = conversations[conversation_id]
+          conversation.messages = conversation.messages[:start] + messages
+
+        chat_log.record_count += 1
+        chat_log.size = file.tell()
+
+    chat_log.track(cast(ChatData, data))
+    for conversation in cast(ChatData, data)['conversations'].values():
+      conversation.archive()
+
+    return cast(ChatData, data), chat_log
+
+  async def __migrate_legacy_data(self) -> dict[int, ChatData]:
+    all_chat_data = await _load_legacy_chat_data(self.__legacy_filepath)
+    if not all_chat_data:
+      return {}
+
+    for chat_id, chat_data in all_chat_data.items():
+      chat_log = _ChatLog()
+      self.__compact(chat_id, chat_data, chat_log)
+      chat_log.track(chat_data)
+      self.__chat_logs[chat_id] = chat_log
+
+    logging.info(f"Migrated data of {len(all_chat_data)} chats from {self.__legacy_filepath} to {self.__directory}")
+
+    return all_chat_data
+
+class SQLitePersistence(ChatDataPersistence):
+  def __init__(self, filepath: str, *, legacy_filepath: str|None = None, update_interval: float = 10, owns_chat: Callable[[int], bool]|None = None):
+    super().__init__(update_interval, owns_chat)
+    self.__filepath = filepath
+    self.__legacy_filepath = legacy_filepath
+    self.__written_chat_data: dict[int, _WrittenChatData] = {}
+    self.__connection: sqlite3.Connection|None = None
+
+  @property
+  def __database(self) -> sqlite3.Connection:
+    if not self.__connection:
+      self.__connection = sqlite3.connect(self.__filepath)
+      self.__connection.execute('PRAGMA journal_mode=WAL')
+      self.__connection.execute('PRAGMA synchronous=NORMAL')
+      # Worker processes sharing the database wait for each other's writes instead of failing
+      self.__connection.execute('PRAGMA busy_timeout=5000')
+      has_message_ids = self.__connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_ids'").fetchone() is not None
+      self.__connection.executescript('''
+        CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, settings BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS conversations (chat_id INTEGER NOT NULL, conversation_id INTEGER NOT NULL, started_at TIMESTAMP NOT NULL, title TEXT, header BLOB NOT NULL, PRIMARY KEY (chat_id, conversation_id));
+        CREATE INDEX IF NOT EXISTS conversations_started_at ON conversations (chat_id, started_at);
+        CREATE TABLE IF NOT EXISTS messages (chat_id INTEGER NOT NULL, conversation_id INTEGER NOT NULL, position INTEGER NOT NULL, message BLOB NOT NULL, PRIMARY KEY (chat_id, conversation_id, position));
+        CREATE TABLE IF NOT EXISTS message_ids (chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, conversation_id INTEGER NOT NULL, PRIMARY KEY (chat_id, message_id));
+      ''')
+      if not has_message_ids:
+        self.__index_stored_message_ids(self.__connection)
+    return self.__connection
+
+  async def get_chat_data(self) -> dict[int, ChatData]:
+    with _startup_lock(self.__filepath + '.lock'):
+      all_chat_data = await self.__load_chat_data()
+    return {chat_id: chat_data for chat_id, chat_data in all_chat_data.items() if self.owns_chat(chat_id)}
+
+  async def __load_chat_data(self) -> dict[int, ChatData]:
+    is_new = not os.path.exists(self.__filepath)
+
+    all_chat_data = {}
+    for chat_id, settings in self.__database.execute('SELECT chat_id, settings FROM chats'):
+      if not self.owns_chat(chat_id):
+        continue
+      all_chat_data[chat_id] = {**pickle.loads(settings), 'conversations': {}}
+      self.__written_chat_data[chat_id] = _WrittenChatData(settings=settings)
+
+    for chat_id, header in self.__database.execute('SELECT chat_id, header FROM conversations ORDER BY chat_id, started_at'):
+      if chat_id not in all_chat_data:
+        continue
+      conversation = cast(Conversation, pickle.loads(header))
+      all_chat_data[chat_id]['conversations'][conversation.id] = conversation
+      self.__written_chat_data[chat_id].headers[conversation.id] = header
+
+    if is_new:
+      legacy_chat_data = await _load_legacy_chat_data(self.__legacy_filepath)
+      for chat_id, chat_data in legacy_chat_data.items():
+        await self.update_chat_data(chat_id, chat_data)
+      if legacy_chat_data:
+        logging.info(f"Migrated data of {len(legacy_chat_data)} chats from {self.__legacy_filepath} to {self.__filepath}")
+      return legacy_chat_data
+
+    logging.info(f"Loaded conversation titles of {len(all_chat_data)} chats from {self.__filepath}")
+
+    return cast(dict[int, ChatData], all_chat_data)
+
+  def load_messages(self, chat_id: int, conversation: Conversation):
+    written_chat_data = self.__written_chat_data.get(chat_id)
+    if not written_chat_data or conversation.id in written_chat_data.fingerprints or conversation.id not in written_chat_data.headers:
+      return
+
+    rows = self.__database.execute('SELECT message FROM messages WHERE chat_id = ? AND conversation_id = ? ORDER BY position', (chat_id, conversation.id))
+    conversation.messages = [cast(Message, pickle.loads(message)) for message, in rows]
+    written_chat_data.fingerprints[conversation.id] = [_fingerprint(message) for message in conversation.messages]
+    conversation.archive()
+
+    logging.info(f"Loaded {len(conversation.messages)} messages of conversation {conversation.id} for chat {chat_id}")
+
+  def read_messages(self, chat_id: int, conversation: Conversation) -> list[Message]:
+    written_chat_data = self.__written_chat_data.get(chat_id)
+    if not written_chat_data or conversation.id in written_chat_data.fingerprints or conversation.id not in written_chat_data.headers:
+      return conversation.messages
+
+    # Messages are read without being kept in memory, unlike when a conversation is loaded
+    rows = self.__database.execute('SELECT message FROM messages WHERE chat_id = ? AND conversation_id = ? ORDER BY position', (chat_id, conversation.id))
+    return [cast(Message, pickle.loads(message)) for message, in rows]
+
+  def read_message_ids(self, chat_id: int) -> dict[int, int]:
+    return dict(self.__database.execute('SELECT message_id, conversation_id FROM message_ids WHERE chat_id = ?', (chat_id,)))
+
+  def __index_stored_message_ids(self, connection: sqlite3.Connection):
+    # Databases written before message ids were indexed are indexed once
+    with connection:
+      for chat_id, conversation_id, message in connection.execute('SELECT chat_id, conversation_id, message FROM messages').fetchall():
+        connection.executemany('INSERT OR REPLACE INTO message_ids (chat_id, message_id, conversation_id) VALUES (?, ?, ?)', ((chat_id, message_id, conversation_id) for message_id in get_message_ids(pickle.loads(message))))
+
+  async def update_chat_data(self, chat_id: int, data: ChatData):
+    written_chat_data = self.__written_chat_data.get(chat_id)
+    if not written_chat_data:
+      written_chat_data = _WrittenChatData()
+      self.__written_chat_data[chat_id] = written_chat_data
+
+    changes = _diff_chat_data(written_chat_data, data)
+    conversations = data.get('conversations', {})
+
+    with self.__database:
+      if changes.settings is not None:
+        self.__database.execute('INSERT OR REPLACE INTO chats (chat_id, settings) VALUES (?, ?)', (chat_id, changes.settings))
+
+      for conversation_id, header in changes.headers.items():
+        conversation = conversations[conversation_id]
+        self.__database.execute('INSERT OR REPLACE INTO conversations (chat_id, conversation_id, started_at, title, header) VALUES (?, ?, ?, ?, ?)', (chat_id, conversation_id, conversation.started_at.isoformat(), conversation.title, header))
+
+      for conversation_id, (start, messages) in changes.messages.items():
+        self.__database.execute('DELETE FROM messages WHERE chat_id = ? AND conversation_id = ? AND position >= ?', (chat_id, conversation_id, start))
+        self.__database.executemany('INSERT INTO messages (chat_id, conversation_id, position, message) VALUES (?, ?, ?, ?)', ((chat_id, conversation_id, start + index, pickle.dumps(message, pickle.HIGHEST_PROTOCOL)) for index, message in enumerate(messages)))
+        self.__database.executemany('INSERT OR REPLACE INTO message_ids (chat_id, message_id, conversation_id) VALUES (?, ?, ?)', ((chat_id, message_id, conversation_id) for message in messages for message_id in get_message_ids(message)))
+
+  async def drop_chat_data(self, chat_id: int):
+    self.__written_chat_data.pop(chat_id, None)
+    with self.__database:
+      for table in ('chats', 'conversations', 'messages', 'message_ids'):
+        self.__database.execute(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+
+  async def refresh_chat_data(self, chat_id: int, chat_data: ChatData):
+    pass
+
+  async def flush(self):
+    if self.__connection:
+      self.__connection.close()
+      self.__connection = None
+
+    logging.info(f"Flushed data of {len(self.__written_chat_data)} chats to {self.__filepath}")
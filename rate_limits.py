@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Hashable
+
+class Priority(IntEnum):
+  INTERACTIVE = 0
+  BACKGROUND = 1
+
+class TokenBucket:
+  def __init__(self, rate_per_minute: float):
+    self.__capacity = rate_per_minute
+    self.__rate = rate_per_minute / 60
+    self.__tokens = rate_per_minute
+    self.__updated_at = 0.0
+
+  def __refill(self, now: float):
+    if self.__updated_at:
+      self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated_at) * self.__rate)
+    self.__updated_at = now
+
+  def wait_time(self, amount: float, now: float) -> float:
+    self.__refill(now)
+    # A request larger than the bucket only waits for a full bucket, and the overdraft delays later requests
+    missing = min(amount, self.__capacity) - self.__tokens
+    return max(missing / self.__rate, 0)
+
+  def consume(self, amount: float, now: float):
+    self.__refill(now)
+    self.__tokens -= amount
+
+@dataclass
+class _Waiter:
+  token_count: int
+  future: asyncio.Future
+
+class RequestScheduler:
+  def __init__(self, *, requests_per_minute: int|None = None, tokens_per_minute: int|None = None):
+    self.__request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+    self.__token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+    self.__queues: list[OrderedDict[Hashable, deque[_Waiter]]] = [OrderedDict() for _ in Priority]
+    self.__wakeup = asyncio.Event()
+    self.__task: asyncio.Task|None = None
+
+  @property
+  def is_enabled(self) -> bool:
+    return self.__request_bucket is not None or self.__token_bucket is not None
+
+  async def acquire(self, key: Hashable, priority: Priority, token_count: int):
+    if not self.is_enabled:
+      return
+
+    waiter = _Waiter(token_count, asyncio.get_running_loop().create_future())
+    self.__queues[priority].setdefault(key, deque()).append(waiter)
+
+    self.__wakeup.set()
+    if not self.__task or self.__task.done():
+      self.__task = asyncio.create_task(self.__run())
+
+    # A cancelled waiter is skipped by the dispatcher without consuming any budget
+    await waiter.future
+
+  def try_acquire(self, token_count: int) -> bool:
+    if not self.is_enabled:
+      return True
+    # Queued requests are not overtaken
+    if self.__next_waiter():
+      return False
+
+    now = asyncio.get_running_loop().time()
+    if (self.__request_bucket and self.__request_bucket.wait_time(1, now) > 0) or (self.__token_bucket and self.__token_bucket.wait_time(token_count, now) > 0):
+      return False
+
+    if self.__request_bucket:
+      self.__request_bucket.consume(1, now)
+    if self.__token_bucket:
+      self.__token_bucket.consume(token_count, now)
+    return True
+
+  def record_usage(self, token_count: int):
+    if self.__token_bucket:
+      self.__token_bucket.consume(token_count, asyncio.get_running_loop().time())
+
+  def __next_waiter(self) -> tuple[OrderedDict[Hashable, deque[_Waiter]], Hashable, _Waiter]|None:
+    for queue in self.__queues:
+      for key, waiters in list(queue.items()):
+        while waiters and waiters[0].future.done():
+          waiters.popleft()
+        if waiters:
+          return queue, key, waiters[0]
+        del queue[key]
+    return None
+
+  async def __run(self):
+    loop = asyncio.get_running_loop()
+
+    while next_waiter := self.__next_waiter():
+      self.__wakeup.clear()
+      queue, key, waiter = next_waiter
+      now = loop.time()
+
+      wait_time = max(
+        self.__request_bucket.wait_time(1, now) if self.__request_bucket else 0,
+        self.__token_bucket.wait_time(waiter.token_count, now) if self.__token_bucket else 0,
+      )
+      if wait_time > 0:
+        logging.debug(f"Waiting {wait_time:.2f} seconds for rate limits before sending request for {key}")
+        # Wake up early when a request with a higher priority arrives
+        try:
+          await asyncio.wait_for(self.__wakeup.wait(), wait_time)
+        except TimeoutError:
+          pass
+        continue
+
+      if self.__request_bucket:
+        self.__request_bucket.consume(1, now)
+      if self.__token_bucket:
+        self.__token_bucket.consume(waiter.token_count, now)
+
+      # Rotate the key to the back so that requests of different keys take turns
+      queue[key].popleft()
+      queue.move_to_end(key)
+      waiter.future.set_result(None)
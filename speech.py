@@ -1,22 +1,119 @@
-import aiohttp
+import asyncio
+import logging
+import random
+import re
+from aiohttp import ClientConnectionError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
+from ogg import join_opus
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, TypeVar
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+
+AUDIO_CHUNK_SIZE = 64 * 1024
+VOICE_NAME = 'en-US-AriaNeural'
+MAX_SYNTHESIS_TEXT_LENGTH = 1000
+MAX_CONCURRENT_SYNTHESES = 4
+
+MAX_CONNECTIONS = 20
+MAX_CONCURRENT_REQUESTS = 10
+KEEPALIVE_TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = 60
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+T = TypeVar('T')
+
+def split_text(text: str, max_length: int) -> list[str]:
+  # Chunks end at sentences when possible, then at words, so that each one is read out naturally
+  pieces = []
+  for sentence in re.split(r'(?<=[.!?。！？\n])\s+', text.strip()):
+    while len(sentence) > max_length:
+      end = sentence.rfind(' ', 0, max_length)
+      end = end if end > 0 else max_length
+      pieces.append(sentence[:end])
+      sentence = sentence[end:].lstrip()
+    pieces.append(sentence)
+
+  chunks = []
+  for piece in pieces:
+    if chunks and len(chunks[-1]) + len(piece) + 1 <= max_length:
+      chunks[-1] += ' ' + piece
+    elif piece:
+      chunks.append(piece)
+  return chunks
 
 class SpeechClient:
-  def __init__(self, key: str, region: str = 'westus'):
+  def __init__(self, key: str, region: str = 'westus', *, max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS):
     self.__key = key
     self.__region = region
-    self.__session = aiohttp.ClientSession(trust_env=True)
+    self.__session: ClientSession|None = None
+    self.__semaphore = asyncio.Semaphore(max_concurrent_requests)
+    self.in_flight_count = 0
+    self.queued_count = 0
+
+  @property
+  def __client_session(self) -> ClientSession:
+    # Created on first use so that it's bound to the running event loop
+    if not self.__session or self.__session.closed:
+      connector = TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+      self.__session = ClientSession(connector=connector, trust_env=True)
+    return self.__session
+
+  @property
+  def voice_name(self) -> str:
+    return VOICE_NAME
+
+  async def read_file(self, path_or_url: str) -> AsyncIterator[bytes]:
+    # Files are downloaded in chunks so that they can be forwarded without being held in memory as a whole
+    if urlparse(path_or_url).scheme not in ('http', 'https'):
+      with open(path_or_url, 'rb') as file:
+        while chunk := await asyncio.to_thread(file.read, AUDIO_CHUNK_SIZE):
+          yield chunk
+      return
+
+    async with self.__client_session.get(path_or_url, timeout=ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=REQUEST_TIMEOUT)) as response:
+      # The URL of a Telegram file contains the bot token, so it's left out of the error
+      if not response.ok:
+        raise ValueError(f"Downloading the file failed with status {response.status} {response.reason}")
+      async for chunk in response.content.iter_chunked(AUDIO_CHUNK_SIZE):
+        yield chunk
 
-  async def speech_to_text(self, audio: bytes) -> str:
+  async def speech_to_text(self, audio: bytes|AsyncIterable[bytes]) -> str:
     headers = {
       'Ocp-Apim-Subscription-Key': self.__key,
       'Content-Type': 'audio/ogg',
     }
-    response = await self.__session.post(f"https://{self.__region}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?language=en-US", headers=headers, data=audio)
-    return (await response.json())['DisplayText']
+    async def parse(response: ClientResponse) -> str:
+      result = await response.json()
+      status = result.get('RecognitionStatus')
+      if status in ('NoMatch', 'InitialSilenceTimeout', 'BabbleTimeout'):
+        return ''
+      if status != 'Success' or 'DisplayText' not in result:
+        raise ValueError(f"Speech recognition failed with status {status}")
+      return result['DisplayText']
 
-  async def text_to_speech(self, text: str) -> bytes:
-    name = 'en-US-AriaNeural'
+    # An async iterable is uploaded with chunked transfer encoding while it's still being read, so recognition starts early.
+    # It can't be read again, so the request is only retried when the audio is in memory.
+    url = f"https://{self.__region}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?language=en-US"
+    return await self.__request(url, headers, audio, parse, is_retryable=isinstance(audio, bytes))
 
+  async def text_to_speech(self, text: str, *, semaphore: asyncio.Semaphore|None = None) -> bytes:
+    # Long text is synthesized in chunks in parallel, and the audio of the chunks is joined in order.
+    # Callers synthesizing several texts for the same reply pass a shared semaphore, so that the limit applies to all of them.
+    semaphore = semaphore or asyncio.Semaphore(MAX_CONCURRENT_SYNTHESES)
+
+    async def synthesize(chunk: str) -> bytes:
+      async with semaphore:
+        return await self.__synthesize(chunk)
+
+    chunks = split_text(text, MAX_SYNTHESIS_TEXT_LENGTH)
+    # Without any chunks, the joined audio would be empty and be sent as a broken voice message
+    if not chunks:
+      raise ValueError("There is no text to synthesize")
+    return join_opus(await asyncio.gather(*(synthesize(chunk) for chunk in chunks)))
+
+  async def __synthesize(self, text: str) -> bytes:
     headers = {
       'Ocp-Apim-Subscription-Key': self.__key,
       'Content-Type': 'application/ssml+xml',
@@ -24,16 +121,58 @@ class SpeechClient:
     }
     data = f"""
     <speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang="en-US">
-      <voice xml:gender="Female" name="{name}">
+      <voice xml:gender="Female" name="{self.voice_name}">
         <mstts:express-as style="chat">
-          {text}
+          {escape(text)}
         </mstts:express-as>
       </voice>
     </speak>
     """
 
-    response = await self.__session.post(f"https://{self.__region}.tts.speech.microsoft.com/cognitiveservices/v1", headers=headers, data=data)
-    return await response.content.read()
+    url = f"https://{self.__region}.tts.speech.microsoft.com/cognitiveservices/v1"
+    return await self.__request(url, headers, data.encode(), lambda response: response.read())
+
+  async def __request(self, url: str, headers: dict[str, str], data: bytes|AsyncIterable[bytes], parse: Callable[[ClientResponse], Awaitable[T]], *, is_retryable: bool = True) -> T:
+    self.queued_count += 1
+    if self.__semaphore.locked():
+      logging.info(f"Speech request queued behind {self.in_flight_count} requests in flight, {self.queued_count} queued")
+
+    try:
+      await self.__semaphore.acquire()
+    finally:
+      self.queued_count -= 1
+
+    self.in_flight_count += 1
+    try:
+      attempt = 0
+      while True:
+        attempt += 1
+        can_retry = is_retryable and attempt < MAX_ATTEMPTS
+        try:
+          timeout = ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=CONNECT_TIMEOUT)
+          async with self.__client_session.post(url, headers=headers, data=data, timeout=timeout) as response:
+            if response.status in RETRY_STATUSES and can_retry:
+              retry_after = response.headers.get('Retry-After')
+              await self.__wait_for_retry(attempt, f"status {response.status}", float(retry_after) if retry_after and retry_after.isdigit() else None)
+              continue
+
+            response.raise_for_status()
+            return await parse(response)
+        except (ClientConnectionError, TimeoutError) as e:
+          if not can_retry:
+            raise
+          await self.__wait_for_retry(attempt, str(e) or type(e).__name__)
+    finally:
+      self.in_flight_count -= 1
+      self.__semaphore.release()
+
+  async def __wait_for_retry(self, attempt: int, reason: str, retry_after: float|None = None):
+    # Full jitter spreads out retries of requests that failed together, so that they don't fail together again
+    delay = retry_after or random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt)
+    logging.warning(f"Speech request failed with {reason}, retrying in {delay:.2f} seconds")
+    await asyncio.sleep(delay)
 
   async def close(self):
-    await self.__session.close()
+    if self.__session:
+      await self.__session.close()
+      self.__session = None
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+
+def speech_key(voice_name: str, text: str) -> str:
+  return hashlib.sha256(f"{voice_name}\n{text}".encode()).hexdigest()
+
+@dataclass
+class _CachedSpeech:
+  size: int
+  audio: bytes|None = None
+  file_id: str|None = None
+
+class SpeechCache:
+  def __init__(self, *, max_size: int, directory: str|None = None):
+    self.__max_size = max_size
+    self.__directory = directory
+    self.__entries: OrderedDict[str, _CachedSpeech] = OrderedDict()
+    self.__size = 0
+
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+      self.__load()
+
+  def get_file_id(self, key: str) -> str|None:
+    entry = self.__entries.get(key)
+    if not entry or not entry.file_id:
+      return None
+
+    # Speeches reused by file ID are used as much as those read from the cache
+    self.__touch(key)
+    return entry.file_id
+
+  def get_audio(self, key: str) -> bytes|None:
+    entry = self.__entries.get(key)
+    if not entry:
+      return None
+
+    self.__touch(key)
+    if not self.__directory:
+      return entry.audio
+
+    try:
+      with open(self.__path(key, '.ogg'), 'rb') as file:
+        return file.read()
+    except OSError as e:
+      logging.warning(f"Could not read cached speech {key}: {e}")
+      self.__remove(key)
+      return None
+
+  def put(self, key: str, audio: bytes, file_id: str|None = None):
+    self.__remove(key)
+
+    entry = _CachedSpeech(len(audio), None if self.__directory else audio, file_id)
+    if self.__directory:
+      with open(self.__path(key, '.ogg'), 'wb') as file:
+        file.write(audio)
+      self.__write_file_id(key, file_id)
+
+    self.__entries[key] = entry
+    self.__size += entry.size
+    self.__evict()
+
+  def set_file_id(self, key: str, file_id: str):
+    entry = self.__entries.get(key)
+    if not entry or entry.file_id == file_id:
+      return
+
+    entry.file_id = file_id
+    if self.__directory:
+      self.__write_file_id(key, file_id)
+
+  def __touch(self, key: str):
+    self.__entries.move_to_end(key)
+    if self.__directory:
+      try:
+        os.utime(self.__path(key, '.ogg'))
+      except OSError:
+        pass
+
+  def __load(self):
+    assert self.__directory
+    # The modification time of the audio file records when it was last used
+    audio_files = [entry for entry in os.scandir(self.__directory) if entry.name.endswith('.ogg')]
+    for audio_file in sorted(audio_files, key=lambda entry: entry.stat().st_mtime):
+      key = audio_file.name.removesuffix('.ogg')
+      file_id = None
+      try:
+        with open(self.__path(key, '.file_id')) as file:
+          file_id = file.read().strip() or None
+      except FileNotFoundError:
+        pass
+
+      self.__entries[key] = _CachedSpeech(audio_file.stat().st_size, file_id=file_id)
+      self.__size += audio_file.stat().st_size
+
+    self.__evict()
+    logging.info(f"Loaded {len(self.__entries)} cached speeches of {self.__size} bytes from {self.__directory}")
+
+  def __evict(self):
+    while self.__size > self.__max_size and self.__entries:
+      self.__remove(next(iter(self.__entries)))
+
+  def __remove(self, key: str):
+    entry = self.__entries.pop(key, None)
+    if not entry:
+      return
+
+    self.__size -= entry.size
+    if self.__directory:
+      for suffix in ('.ogg', '.file_id'):
+        try:
+          os.remove(self.__path(key, suffix))
+        except FileNotFoundError:
+          pass
+
+  def __write_file_id(self, key: str, file_id: str|None):
+    if file_id:
+      with open(self.__path(key, '.file_id'), 'w') as file:
+        file.write(file_id)
+
+  def __path(self, key: str, suffix: str) -> str:
+    assert self.__directory
+    return os.path.join(self.__directory, key + suffix)
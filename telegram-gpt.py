@@ -1,6 +1,7 @@
 import argparse
 import logging
 import os
+from backends import BackendOptions
 from bot import BotOptions, WebhookOptions, run
 from gpt import GPTClient, GPTOptions
 from speech import SpeechClient
@@ -25,6 +26,17 @@ if __name__ == "__main__":
 
     return chat_ids
 
+  def get_additional_backends_from_env():
+    backends = []
+
+    while True:
+      backend = os.environ.get('TELEGRAM_GPT_OPENAI_ADDITIONAL_BACKEND_' + str(len(backends)))
+      if backend is None:
+        break
+      backends.append(BackendOptions.parse(backend))
+
+    return backends
+
   parser = argparse.ArgumentParser()
   parser.add_argument(
     '--openai-api-key',
@@ -54,12 +66,42 @@ if __name__ == "__main__":
     default=int(os.environ['TELEGRAM_GPT_CONVERSATION_TIMEOUT']) if 'TELEGRAM_GPT_CONVERSATION_TIMEOUT' in os.environ else None,
     help="Timeout in seconds for a conversation to expire. If not specified, the bot will keep the conversation alive indefinitely.",
   )
+  parser.add_argument(
+    '--stream-by-sentence',
+    action='store_true',
+    default=os.environ.get('TELEGRAM_GPT_STREAM_BY_SENTENCE', '').lower() in ('1', 'true', 'yes'),
+    help="Only update a response that is being generated when a sentence or paragraph is complete. This reduces the number of message edits. If not specified, the response will be updated with partial sentences.",
+  )
+  parser.add_argument(
+    '--merge-messages',
+    action='store_true',
+    default=os.environ.get('TELEGRAM_GPT_MERGE_MESSAGES', '').lower() in ('1', 'true', 'yes'),
+    help="Merge messages sent while a response is being generated into a single message, and respond to them at once. If not specified, each message will be responded to in order.",
+  )
+  parser.add_argument(
+    '--interrupt-generation',
+    action='store_true',
+    default=os.environ.get('TELEGRAM_GPT_INTERRUPT_GENERATION', '').lower() in ('1', 'true', 'yes'),
+    help="Stop generating the current response when a new message is sent, and respond to the new message right away. If not specified, the new message will be responded to after the current response is complete.",
+  )
   parser.add_argument(
     '--max-message-count',
     type=int,
     default=int(os.environ['TELEGRAM_GPT_MAX_MESSAGE_COUNT']) if 'TELEGRAM_GPT_MAX_MESSAGE_COUNT' in os.environ else None,
     help="Maximum number of messages to keep in the conversation. Earlier messages will be discarded with this option set. If not specified, the bot will keep all messages in the conversation.",
   )
+  parser.add_argument(
+    '--max-context-tokens',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_MAX_CONTEXT_TOKENS']) if 'TELEGRAM_GPT_MAX_CONTEXT_TOKENS' in os.environ else None,
+    help="Maximum number of tokens of the conversation to send as context for each response, including the mode prompt. Earlier messages that don't fit will be left out. The latest message is always sent. If not specified, a budget based on the context size of the model will be used.",
+  )
+  parser.add_argument(
+    '--summarize-history',
+    action='store_true',
+    default=os.environ.get('TELEGRAM_GPT_SUMMARIZE_HISTORY', '').lower() in ('1', 'true', 'yes'),
+    help="Summarize earlier messages that no longer fit in the context in the background, and send the summary along with the recent messages. If not specified, earlier messages will be left out.",
+  )
 
   parser.add_argument(
     '--data-dir',
@@ -67,6 +109,13 @@ if __name__ == "__main__":
     default=os.environ.get('TELEGRAM_GPT_DATA_DIR'),
     help="Directory to store data. If not specified, data won't be persisted.",
   )
+  parser.add_argument(
+    '--storage',
+    type=str,
+    choices=['log', 'sqlite'],
+    default=os.environ.get('TELEGRAM_GPT_STORAGE') or 'log',
+    help="Storage engine for persisted data. 'log' keeps an append-only log for each chat and loads all data at startup. 'sqlite' keeps data in a SQLite database and only loads messages of a conversation when it's resumed. Only valid when --data-dir is set. Default to be log.",
+  )
   parser.add_argument(
     '--webhook-url',
     type=str,
@@ -79,6 +128,12 @@ if __name__ == "__main__":
     default=os.environ.get('TELEGRAM_GPT_WEBHOOK_LISTEN_ADDRESS') or '0.0.0.0:80',
     help="Address to listen for telegram webhook requests in the format of <ip>:<port>. Only valid when --webhook-url is set. If not specified, 0.0.0.0:80 would be used.",
   )
+  parser.add_argument(
+    '--workers',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_WORKERS']) if 'TELEGRAM_GPT_WORKERS' in os.environ else 1,
+    help="Number of processes to handle updates in. Each chat is always handled by the same process. Default to be 1. Only valid when --webhook-url is set.",
+  )
 
   parser.add_argument(
     '--openai-model-name',
@@ -86,6 +141,18 @@ if __name__ == "__main__":
     default=os.environ.get('TELEGRAM_GPT_OPENAI_MODEL_NAME') or 'gpt-3.5-turbo',
     help="Chat completion model name (https://platform.openai.com/docs/models/model-endpoint-compatibility). If --azure-openai-endpoint is specified, this is the Azure OpenAI Service model deployment name. Default to be gpt-3.5-turbo.",
   )
+  parser.add_argument(
+    '--title-model-name',
+    type=str,
+    default=os.environ.get('TELEGRAM_GPT_TITLE_MODEL_NAME'),
+    help="Chat completion model name, or Azure OpenAI Service model deployment name, used to generate conversation titles. A cheaper model can be used since titles are generated from a short excerpt of the first exchange. Default to be the same as --openai-model-name.",
+  )
+  parser.add_argument(
+    '--local-titles',
+    action='store_true',
+    default=os.environ.get('TELEGRAM_GPT_LOCAL_TITLES', '').lower() in ('1', 'true', 'yes'),
+    help="Title conversations with the first words of the first message instead of generating titles with OpenAI API.",
+  )
   parser.add_argument(
     '--azure-openai-endpoint',
     type=str,
@@ -93,6 +160,44 @@ if __name__ == "__main__":
     help="Azure OpenAI Service endpoint. Set this option to use Azure OpenAI Service instead of OpenAI API."
   )
 
+  parser.add_argument(
+    '--openai-additional-backend',
+    action='append',
+    type=BackendOptions.parse,
+    default=get_additional_backends_from_env(),
+    help="Additional OpenAI API key or Azure OpenAI Service deployment to balance requests across, in the format of api_key=<key>[,azure_endpoint=<endpoint>][,model_name=<model>][,weight=<weight>]. Can be specified multiple times. Requests are routed to the backend with the fewest outstanding requests and lowest latency, and fail over to another backend when one is overloaded or unavailable.",
+  )
+  parser.add_argument(
+    '--openai-max-connections',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_OPENAI_MAX_CONNECTIONS']) if 'TELEGRAM_GPT_OPENAI_MAX_CONNECTIONS' in os.environ else 100,
+    help="Maximum number of concurrent connections to OpenAI API or Azure OpenAI Service. Default to be 100.",
+  )
+  parser.add_argument(
+    '--openai-requests-per-minute',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_OPENAI_REQUESTS_PER_MINUTE']) if 'TELEGRAM_GPT_OPENAI_REQUESTS_PER_MINUTE' in os.environ else None,
+    help="Maximum number of requests per minute sent to OpenAI API or Azure OpenAI Service. Requests over the limit are queued, with replies ahead of titles and summaries and requests of different chats taking turns. Default to be unlimited.",
+  )
+  parser.add_argument(
+    '--openai-tokens-per-minute',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_OPENAI_TOKENS_PER_MINUTE']) if 'TELEGRAM_GPT_OPENAI_TOKENS_PER_MINUTE' in os.environ else None,
+    help="Maximum number of estimated tokens per minute sent to and generated by OpenAI API or Azure OpenAI Service. Requests over the limit are queued like --openai-requests-per-minute. Default to be unlimited.",
+  )
+  parser.add_argument(
+    '--completion-cache-size',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_COMPLETION_CACHE_SIZE']) if 'TELEGRAM_GPT_COMPLETION_CACHE_SIZE' in os.environ else 0,
+    help="Maximum number of replies to cache for the first question of conversations. A question asked again with the same mode is answered from the cache, least recently used replies are evicted first. The cache is stored in --data-dir if set. Default to be 0, which disables the cache.",
+  )
+  parser.add_argument(
+    '--completion-cache-ttl',
+    type=float,
+    default=float(os.environ['TELEGRAM_GPT_COMPLETION_CACHE_TTL']) if 'TELEGRAM_GPT_COMPLETION_CACHE_TTL' in os.environ else 86400,
+    help="Time in seconds a cached reply stays valid. Default to be 86400 (1 day). Only valid when --completion-cache-size is set.",
+  )
+
   parser.add_argument(
     '--azure-speech-key',
     type=str,
@@ -105,17 +210,27 @@ if __name__ == "__main__":
     default=os.environ.get('TELEGRAM_GPT_AZURE_SPEECH_REGION') or 'westus',
     help="Azure Speech Services region. Default to be westus. Only valid when --azure-speech-key is set.",
   )
+  parser.add_argument(
+    '--speech-cache-size',
+    type=int,
+    default=int(os.environ['TELEGRAM_GPT_SPEECH_CACHE_SIZE']) if 'TELEGRAM_GPT_SPEECH_CACHE_SIZE' in os.environ else 100,
+    help="Maximum size in megabytes of generated audio to cache, so that a message read out again is sent right away. The cache is stored in --data-dir if set. Set to 0 to disable the cache. Default to be 100. Only valid when --azure-speech-key is set.",
+  )
   
   args = parser.parse_args()
+  if args.workers < 1:
+    parser.error('--workers must be at least 1')
+  if args.workers > 1 and args.webhook_url is None:
+    parser.error('--workers requires --webhook-url')
 
-  gpt_options = GPTOptions(args.openai_api_key, args.openai_model_name, args.azure_openai_endpoint, args.max_message_count)
+  gpt_options = GPTOptions(args.openai_api_key, args.openai_model_name, args.azure_openai_endpoint, args.max_message_count, args.max_context_tokens, args.summarize_history, args.openai_max_connections, requests_per_minute=args.openai_requests_per_minute, tokens_per_minute=args.openai_tokens_per_minute, title_model_name=args.title_model_name, local_titles=args.local_titles, completion_cache_size=args.completion_cache_size, completion_cache_ttl=args.completion_cache_ttl, completion_cache_filepath=os.path.join(args.data_dir, 'completions.sqlite3') if args.data_dir else None, additional_backends=args.openai_additional_backend)
   logging.info(f"Initializing GPTClient with options: {gpt_options}")
   gpt = GPTClient(options=gpt_options)
 
   speech = SpeechClient(args.azure_speech_key, args.azure_speech_region) if args.azure_speech_key is not None else None
 
   webhook_options = WebhookOptions(args.webhook_url, args.webhook_listen_address) if args.webhook_url is not None else None
-  bot_options = BotOptions(args.telegram_token, set(args.chat_id), args.conversation_timeout, args.data_dir, webhook_options)
+  bot_options = BotOptions(args.telegram_token, set(args.chat_id), args.conversation_timeout, args.data_dir, args.storage, args.stream_by_sentence, args.merge_messages, args.interrupt_generation, args.speech_cache_size * 1024 * 1024, args.workers, webhook_options)
   logging.info(f"Starting bot with options: {bot_options}")
 
   run(args.telegram_token, gpt, speech, bot_options)
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable
+from models import Conversation, Message, Role, SystemMessage, UserMessage
+
+TITLE_EXCERPT_LENGTH = 300
+HEURISTIC_TITLE_WORD_COUNT = 6
+HEURISTIC_TITLE_LENGTH = 50
+
+TITLE_PROMPT = 'You are a title generator. You will receive the beginning of a conversation. You will reply with only the title of the conversation without any punctuation mark either at the begining or the end.'
+BATCH_TITLE_PROMPT = 'You are a title generator. You will receive the beginnings of {count} conversations, each starting with a line like "### 1". You will reply with exactly {count} lines, each with the number of a conversation, a period and the title of the conversation without any punctuation mark either at the begining or the end.'
+
+def title_excerpt(conversation: Conversation) -> str:
+  # The first question and the beginning of its answer are enough to tell what a conversation is about
+  exchange = [message for message in conversation.messages if message.role != Role.SYSTEM][:2]
+  return '\n\n'.join(f"{message.role.value}: {truncate(message.content, TITLE_EXCERPT_LENGTH)}" for message in exchange)
+
+def truncate(text: str, length: int) -> str:
+  text = ' '.join(text.split())
+  return text if len(text) <= length else text[:length].rsplit(' ', 1)[0] + '...'
+
+def heuristic_title(conversation: Conversation) -> str:
+  first_message = next((message for message in conversation.messages if message.role == Role.USER), None)
+  if not first_message:
+    return 'Untitled'
+
+  words = first_message.content.split()[:HEURISTIC_TITLE_WORD_COUNT]
+  title = truncate(' '.join(words), HEURISTIC_TITLE_LENGTH).strip(' \t\n.,;:!?-"\'')
+  return title[:1].upper() + title[1:] if title else 'Untitled'
+
+def parse_titles(reply: str, count: int) -> list[str|None]:
+  titles: list[str|None] = [None] * count
+  for line in reply.splitlines():
+    match = re.match(r'\s*(?:###\s*)?(\d+)[.):]\s*(.+)', line)
+    if match and 1 <= int(match.group(1)) <= count:
+      titles[int(match.group(1)) - 1] = match.group(2).strip()
+  return titles
+
+class TitleBatcher:
+  def __init__(self, request: Callable[[list[Message]], Awaitable[str]], *, batch_delay: float = 2, max_batch_size: int = 10):
+    self.__request = request
+    self.__batch_delay = batch_delay
+    self.__max_batch_size = max_batch_size
+    self.__pending: list[tuple[str, asyncio.Future]] = []
+    self.__flush_task: asyncio.Task|None = None
+
+  async def generate(self, excerpt: str) -> str|None:
+    future = asyncio.get_running_loop().create_future()
+    self.__pending.append((excerpt, future))
+
+    if len(self.__pending) >= self.__max_batch_size:
+      self.__flush()
+    elif not self.__flush_task:
+      self.__flush_task = asyncio.create_task(self.__flush_later())
+
+    return await future
+
+  async def __flush_later(self):
+    await asyncio.sleep(self.__batch_delay)
+    self.__flush_task = None
+    self.__flush()
+
+  def __flush(self):
+    if self.__flush_task:
+      self.__flush_task.cancel()
+      self.__flush_task = None
+
+    batch, self.__pending = self.__pending, []
+    if batch:
+      asyncio.create_task(self.__generate_batch(batch))
+
+  async def __generate_batch(self, batch: list[tuple[str, asyncio.Future]]):
+    try:
+      if len(batch) == 1:
+        titles = [await self.__request([SystemMessage(TITLE_PROMPT), UserMessage(-1, batch[0][0])])]
+      else:
+        excerpts = '\n\n'.join(f"### {index + 1}\n{excerpt}" for index, (excerpt, _) in enumerate(batch))
+        reply = await self.__request([SystemMessage(BATCH_TITLE_PROMPT.format(count=len(batch))), UserMessage(-1, excerpts)])
+        titles = parse_titles(reply, len(batch))
+        logging.info(f"Generated {sum(1 for title in titles if title)} titles in a batch of {len(batch)} conversations")
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    for (_, future), title in zip(batch, titles):
+      if not future.done():
+        future.set_result(title)
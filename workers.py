@@ -0,0 +1,140 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+from aiohttp import ClientError, ClientSession, ClientTimeout, UnixConnector, web
+from telegram import Bot, Update
+from telegram.ext import Application
+from typing import Callable
+from uuid import uuid4
+
+HASH_RING_REPLICAS = 160
+WORKER_STARTUP_TIMEOUT = 60
+FORWARD_TIMEOUT = 10
+
+class HashRing:
+  def __init__(self, worker_count: int, *, replicas: int = HASH_RING_REPLICAS):
+    # Each worker owns many points on the ring, so that chats are spread evenly and few of them move when workers are added
+    points = sorted((self.__hash(f"{worker}:{replica}"), worker) for worker in range(worker_count) for replica in range(replicas))
+    self.__hashes = [point_hash for point_hash, _ in points]
+    self.__workers = [worker for _, worker in points]
+
+  def worker_for(self, chat_id: int) -> int:
+    index = bisect.bisect(self.__hashes, self.__hash(str(chat_id))) % len(self.__hashes)
+    return self.__workers[index]
+
+  @staticmethod
+  def __hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+def _routing_key(data: dict) -> int:
+  update = Update.de_json(data, None)
+  if update and update.effective_chat:
+    return update.effective_chat.id
+  if update and update.effective_user:
+    return update.effective_user.id
+  return 0
+
+async def _serve_worker(app: Application, socket_path: str):
+  await app.initialize()
+  if app.post_init:
+    await app.post_init(app)
+  await app.start()
+
+  async def handle_update(request: web.Request) -> web.Response:
+    update = Update.de_json(await request.json(), app.bot)
+    await app.update_queue.put(update)
+    return web.Response()
+
+  server = web.Application()
+  server.router.add_post('/', handle_update)
+  runner = web.AppRunner(server)
+  await runner.setup()
+  await web.UnixSite(runner, socket_path).start()
+
+  stopped = asyncio.Event()
+  for signal_number in (signal.SIGINT, signal.SIGTERM):
+    asyncio.get_running_loop().add_signal_handler(signal_number, stopped.set)
+
+  logging.info(f"Worker {os.getpid()} is serving updates on {socket_path}")
+  await stopped.wait()
+
+  await runner.cleanup()
+  await app.stop()
+  await app.shutdown()
+  if app.post_shutdown:
+    await app.post_shutdown(app)
+
+def run_workers(token: str, webhook_url: str, host: str, port: int, worker_count: int, build_application: Callable[[Callable[[int], bool]], Application]):
+  ring = HashRing(worker_count)
+  socket_directory = tempfile.mkdtemp(prefix='telegram-gpt-')
+  socket_paths = [os.path.join(socket_directory, f"worker-{index}.sock") for index in range(worker_count)]
+  secret_token = str(uuid4())
+
+  def run_worker(index: int):
+    # Each chat is handled by a single worker, so the worker is the only writer of its chats' data
+    app = build_application(lambda chat_id: ring.worker_for(chat_id) == index)
+    asyncio.run(_serve_worker(app, socket_paths[index]))
+
+  # Workers are forked so that they inherit the clients and options that have been set up
+  context = multiprocessing.get_context('fork')
+  processes = [context.Process(target=run_worker, args=(index,), name=f"worker-{index}") for index in range(worker_count)]
+  for process in processes:
+    process.start()
+
+  sessions: list[ClientSession] = []
+
+  async def forward_update(request: web.Request) -> web.Response:
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+      return web.Response(status=403)
+
+    body = await request.read()
+    worker = ring.worker_for(_routing_key(json.loads(body)))
+    try:
+      async with sessions[worker].post('http://worker/', data=body, headers={'Content-Type': 'application/json'}) as response:
+        return web.Response(status=response.status)
+    except ClientError as e:
+      # Telegram delivers the update again later when it's not acknowledged
+      logging.warning(f"Could not forward update to worker {worker}: {e}")
+      return web.Response(status=503)
+
+  async def on_startup(_: web.Application):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + WORKER_STARTUP_TIMEOUT
+    while not all(os.path.exists(path) for path in socket_paths):
+      if loop.time() > deadline or not all(process.is_alive() for process in processes):
+        raise RuntimeError("Workers failed to start")
+      await asyncio.sleep(0.1)
+
+    sessions.extend(ClientSession(connector=UnixConnector(path), timeout=ClientTimeout(total=FORWARD_TIMEOUT)) for path in socket_paths)
+
+    async with Bot(token) as bot:
+      await bot.set_webhook(webhook_url, secret_token=secret_token)
+    logging.info(f"Routing updates from {webhook_url} to {worker_count} workers")
+
+  async def on_cleanup(_: web.Application):
+    for session in sessions:
+      await session.close()
+
+  router = web.Application()
+  router.router.add_post('/', forward_update)
+  router.on_startup.append(on_startup)
+  router.on_cleanup.append(on_cleanup)
+  try:
+    web.run_app(router, host=host, port=port, print=None)
+  finally:
+    for process in processes:
+      if process.is_alive():
+        process.terminate()
+    for process in processes:
+      process.join()
+
+    for path in socket_paths:
+      if os.path.exists(path):
+        os.remove(path)
+    os.rmdir(socket_directory)